@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+"""Tests for the tfr session record reader
+"""
+
+import os
+import sys
+import random
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import tflipper
+
+
+
+## Tests
+#
+
+class test_tfr_reader(unittest.TestCase):
+  """Record a session spanning several keyframes, then read the frames back
+  out of order
+  """
+
+  def setUp(self):
+    """Record a session of pseudo-random frames
+    """
+
+    rnd = random.Random(0)
+    self.frames = [tflipper.captured_frame(i / 10,
+				bytes(rnd.getrandbits(8) for _ in range(1024)),
+				"u" if i % 7 == 0 else "", False) \
+			for i in range(tflipper.tfr_keyframe_interval * 2 + 50)]
+
+    fd, self.filename = tempfile.mkstemp(suffix = ".tfr")
+    os.close(fd)
+
+    recorder = tflipper.tfr_recorder(SimpleNamespace(bin = self.filename),
+					"Test")
+    for frame in self.frames:
+      recorder.process(frame)
+    recorder.finish(len(self.frames) / 10, "")
+
+
+
+  def tearDown(self):
+    """Delete the session record
+    """
+
+    os.unlink(self.filename)
+
+
+
+  def check_frames(self, frame_numbers):
+    """Read the frames in the given order and compare them with the recorded
+    frames
+    """
+
+    with tflipper.tfr_reader(self.filename) as r:
+      self.assertEqual(r.flipper_name, "Test")
+      self.assertEqual(len(r), len(self.frames))
+      for n in frame_numbers:
+        self.assertEqual(r.frame(n), self.frames[n], "frame {}".format(n))
+
+
+
+  def test_sequential(self):
+    """Read all the frames in sequence
+    """
+
+    self.check_frames(range(len(self.frames)))
+
+
+
+  def test_same_frame_twice(self):
+    """Read the same keyframe and delta frame twice in a row
+    """
+
+    self.check_frames([0, 0, 5, 5, 5, tflipper.tfr_keyframe_interval,
+			tflipper.tfr_keyframe_interval])
+
+
+
+  def test_seek_backwards(self):
+    """Read frames backwards, across keyframes
+    """
+
+    self.check_frames([len(self.frames) - 1, 150, 149, 3, 120, 99, 0])
+
+
+
+  def test_truncated_header(self):
+    """Open an empty file and a file cut in the middle of the header
+    """
+
+    for data in (b"", tflipper.tfr_magic):
+      with open(self.filename, "wb") as f:
+        f.write(data)
+      with self.assertRaisesRegex(ValueError, "is not a tfr file"):
+        tflipper.tfr_reader(self.filename)
+
+
+
+if __name__ == "__main__":
+  unittest.main()
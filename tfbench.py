@@ -0,0 +1,703 @@
+#!/usr/bin/env python3
+"""Flipper Zero remote control for the terminal
+Version: 1.8.0
+
+Headless benchmark
+
+Run the real tflipper capture, render and record loop against a simulated
+Flipper Zero serving the frames of a session record, in all the semigraphic
+densities and with and without recording, and report the frame rates, CPU
+time and peak memory use of each configuration.
+
+Alternatively, time the hot paths -renderers, keymap overlay, steganography
+and image conversions- over a fixed corpus of frames, and check their outputs
+against golden digests
+"""
+
+## Modules
+#
+
+import os
+import sys
+import json
+import random
+import hashlib
+import argparse
+import tempfile
+import subprocess
+from time import time, perf_counter, sleep
+
+import tflipper
+
+try:
+  from flipperzero_protobuf.flipperzero_protobuf_compiled import flipper_pb2
+except:
+  pass
+
+
+
+## Defines
+#
+
+# Default duration of each benchmark session
+default_duration = 5 #s
+
+# Default capture rate: high enough for the capture not to be throttled, so
+# the session runs as fast as the simulated Flipper Zero and the consumers allow
+default_fps = 10000
+
+# Semigraphic densities and session options benchmarked
+densities = (("1x2", []), ("2x3", ["-M"]), ("2x4", ["-H"]))
+modes = (("display", []), ("no display", ["-n"]), ("txt", ["-t", "{}.txt"]),
+		("gif", ["-g", "{}.gif"]), ("tfr", ["-b", "{}.tfr"]))
+
+# Default number of passes over the frame corpus of each micro-benchmark
+default_micro_repeat = 20
+
+# File holding the SHA-256 digests of the outputs of the micro-benchmarks over
+# the frame corpus
+golden_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+				"tfbench_golden.json")
+
+
+
+## Classes
+#
+
+class simulated_flipper_proto:
+  """Stand-in for FlipperProto serving the frames of a session record one
+  after the other, looping at the end, after a configurable latency. Supports
+  both screen snapshot polling and the screen stream
+  """
+
+  def __init__(self, frames, latency = 0):
+    """__init__ method. frames is the list of screen data to serve and latency
+    is how long each screen snapshot or screen stream frame takes to come in
+    """
+
+    self.device_info = {"hardware_name": "Simulated Flipper"}
+
+    self.frames = frames
+    self.latency = latency
+    self.i = 0
+
+
+
+  def next_frame(self):
+    """Wait for the latency, then return the next frame
+    """
+
+    if self.latency:
+      sleep(self.latency)
+
+    frame = self.frames[self.i]
+    self.i = (self.i + 1) % len(self.frames)
+
+    return frame
+
+
+
+  def rpc_gui_snapshot_screen(self):
+    """Return a screen snapshot
+    """
+
+    return self.next_frame()
+
+
+
+  def rpc_gui_send_input(self, flipper_input):
+    """Discard an input event
+    """
+
+    pass
+
+
+
+  def rpc_gui_start_screen_stream(self):
+    """Nothing to do to start the screen stream
+    """
+
+    pass
+
+
+
+  def _rpc_send(self, cmd_data, cmd_name):
+    """Discard a request sent without waiting for its answer
+    """
+
+    pass
+
+
+
+  def _rpc_read_any(self):
+    """Return the next screen stream frame
+    """
+
+    data = flipper_pb2.Main()
+    data.command_id = 0
+    data.gui_screen_frame.data = self.next_frame()
+
+    return data
+
+
+
+## Routines
+#
+
+def load_frames(filename):
+  """Return the screen data of all the frames of a session record
+  """
+
+  record = tflipper.open_record(filename)
+
+  try:
+    return [frame.screen_data for frame in record.frames()]
+
+  finally:
+    record.close()
+
+
+
+def run_session(results_filename, record_filename, latency, tflipper_args):
+  """Run one tflipper session with the simulated Flipper Zero and save the
+  frame counters and the session's duration into the results file. Runs in a
+  child process so its CPU time and peak memory use can be measured alone
+  """
+
+  proto = simulated_flipper_proto(load_frames(record_filename), latency)
+
+  # Count the frames going through the stages
+  tflipper.stats.enable()
+
+  start_time = time()
+  tflipper.main(tflipper_args, proto)
+  duration = time() - start_time
+
+  with open(results_filename, "w") as f:
+    json.dump({"duration": duration, "counters": tflipper.stats.counters}, f)
+
+
+
+def run_benchmark(args, name, tflipper_args, workdir):
+  """Run one benchmark session in a child process and return its results
+  """
+
+  results_filename = os.path.join(workdir, "results.json")
+  if os.path.exists(results_filename):
+    os.remove(results_filename)
+
+  child = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+				"--run-session", results_filename,
+				"-l", str(args.latency), args.record, "--"] + \
+				tflipper_args,
+				stdin = subprocess.DEVNULL,
+				stdout = subprocess.DEVNULL,
+				stderr = subprocess.PIPE)
+
+  # Get the child's CPU time and peak memory use if the platform allows it
+  stderr = child.stderr.read()
+  try:
+    _, status, rusage = os.wait4(child.pid, 0)
+    child.returncode = os.waitstatus_to_exitcode(status)
+    cpu_time = rusage.ru_utime + rusage.ru_stime
+    peak_rss = rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+  except AttributeError:
+    child.wait()
+    cpu_time = None
+    peak_rss = None
+
+  if child.returncode:
+    raise RuntimeError("benchmark {} failed:\n{}".\
+				format(name, stderr.decode("utf-8", "replace")))
+
+  with open(results_filename, "r") as f:
+    results = json.load(f)
+
+  counters = results["counters"]
+  duration = results["duration"]
+
+  return {"name": name,
+	"args": tflipper_args,
+	"duration": duration,
+	"captured_fps": counters.get("frames captured", 0) / duration,
+	"rendered_fps": counters.get("frames rendered", 0) / duration,
+	"recorded_fps": sum([n for c, n in counters.items() \
+				if c.startswith("frames recorded")]) / duration,
+	"cpu_time": cpu_time,
+	"peak_rss": peak_rss}
+
+
+
+def micro_corpus():
+  """Return a fixed corpus of representative frames: blank, full and patterned
+  displays, a frame around the display, text-like lines and random displays
+  of increasing pixel density
+  """
+
+  rng = random.Random(0)
+
+  frames = [bytes(1024), b"\xff" * 1024, b"\x55\xaa" * 512, b"\x0f" * 1024,
+		b"\xff\x00" * 512, bytes(range(256)) * 4,
+		b"\xff" + b"\x01" * 126 + b"\xff" + \
+			(b"\xff" + bytes(126) + b"\xff") * 6 + \
+			b"\xff" + b"\x80" * 126 + b"\xff",
+		bytes(256) + bytes([rng.getrandbits(8) & 0x7f \
+					for _ in range(384)]) + bytes(384)]
+
+  # Random pixels, each of them on with a probability of 1/2 to 1/16
+  for nb_ands in range(1, 5):
+    for _ in range(2):
+      frame = [0xff] * 1024
+      for _ in range(nb_ands):
+        frame = [v & rng.getrandbits(8) for v in frame]
+      frames.append(bytes(frame))
+
+  return frames
+
+
+
+def session_args(density):
+  """Return the tflipper arguments of a session displayed in a density
+  """
+
+  return argparse.Namespace(mid_density_semigraphics = density == "2x3",
+				high_density_semigraphics = density == "2x4",
+				bold = False, numpy = False, no_display = False,
+				incremental_redraw = False)
+
+
+
+def render_case(density, use_numpy):
+  """Micro-benchmark case rendering frames in a density
+  """
+
+  def setup(corpus):
+
+    renderer = tflipper.semigraphics_renderer(density, use_numpy)
+
+    def run(i):
+      return renderer.render(corpus[i])
+
+    def output(i):
+      return "\n".join(run(i)).encode("utf-8")
+
+    return run, output
+
+  return setup
+
+
+
+def keymap_overlay_case(corpus):
+  """Micro-benchmark case displaying frames with the keymap help overlaid
+  """
+
+  display = tflipper.display_output(session_args("1x2"), "[ Flipper Zero ]",
+					"[ Ctrl-C to stop ]",
+					tflipper.semigraphic_keymap_help())
+
+  devnull = open(os.devnull, "wb")
+  output_file = tempfile.TemporaryFile()
+
+  def run(i):
+    display.process(tflipper.captured_frame(i / 30, corpus[i], "", True))
+
+  # Write the console output into a temporary file instead of /dev/null to
+  # get it back
+  def output(i):
+    display.writer.fd = output_file.fileno()
+    run(i)
+    display.writer.fd = devnull.fileno()
+    output_file.seek(0)
+    data = output_file.read()
+    output_file.seek(0)
+    output_file.truncate()
+    return data
+
+  display.writer.fd = devnull.fileno()
+
+  return run, output
+
+
+
+def steg_marker(i):
+  """Return the string the GIF recorder encodes into the image of frame i
+  """
+
+  return "[{}] ".format(i) + tflipper.set_text_invisible + \
+		tflipper.invisible_tc_btn_marker_fmt.format(i / 30,
+							"rL"[:i % 3]) + \
+		tflipper.attributes_reset
+
+
+
+def steg_encode_case(corpus):
+  """Micro-benchmark case encoding markers into images
+  """
+
+  images = [tflipper.screen_data_to_image(frame) for frame in corpus]
+
+  def run(i):
+    tflipper.steg_encode(images[i], steg_marker(i))
+
+  def output(i):
+    run(i)
+    return images[i].tobytes()
+
+  return run, output
+
+
+
+def steg_decode_case(mode):
+  """Micro-benchmark case decoding markers from palette or RGB images
+  """
+
+  def setup(corpus):
+
+    images = []
+    for i, frame in enumerate(corpus):
+      image = tflipper.screen_data_to_image(frame)
+      tflipper.steg_encode(image, steg_marker(i))
+      images.append(image.convert(mode))
+
+    palette = {tuple(tflipper.gif_palette[c * 3 : c * 3 + 3]): c \
+			for c in reversed(range(4))}
+
+    def run(i):
+      return tflipper.steg_decode(images[i], palette)
+
+    def output(i):
+      return run(i).encode("ascii")
+
+    return run, output
+
+  return setup
+
+
+
+def screen_data_to_image_case(corpus):
+  """Micro-benchmark case converting screen data into 512x256 images
+  """
+
+  def run(i):
+    return tflipper.screen_data_to_image(corpus[i])
+
+  def output(i):
+    image = run(i)
+    return bytes(image.getpalette()) + image.tobytes()
+
+  return run, output
+
+
+
+def image_to_screen_data_case(corpus):
+  """Micro-benchmark case converting 512x256 images back into screen data
+  """
+
+  images = [tflipper.screen_data_to_image(frame) for frame in corpus]
+
+  def run(i):
+    return tflipper.image_to_screen_data(images[i])
+
+  return run, run
+
+
+
+def micro_cases():
+  """Return the micro-benchmark cases as (name, golden output name, setup)
+  tuples. Setup is called with the frame corpus and returns a function
+  running the case on a frame of the corpus and a function doing the same and
+  returning its output as bytes. The NumPy renderers share the golden outputs
+  of the table renderers
+  """
+
+  cases = []
+
+  for density in ("1x2", "2x3", "2x4"):
+    cases.append(("render " + density, "render " + density,
+			render_case(density, False)))
+    if hasattr(tflipper, "numpy"):
+      cases.append(("render " + density + " numpy", "render " + density,
+			render_case(density, True)))
+
+  cases.extend([("keymap overlay", "keymap overlay", keymap_overlay_case),
+		("steg encode", "steg encode", steg_encode_case),
+		("steg decode", "steg decode", steg_decode_case("P")),
+		("steg decode rgb", "steg decode", steg_decode_case("RGB")),
+		("screen data to image", "screen data to image",
+			screen_data_to_image_case),
+		("image to screen data", "image to screen data",
+			image_to_screen_data_case)])
+
+  return cases
+
+
+
+def run_micro_benchmarks(args):
+  """Run the micro-benchmarks, check their outputs against the golden outputs
+  or update them, and return the results and whether all the outputs match
+  """
+
+  corpus = micro_corpus()
+
+  try:
+    with open(args.golden, "r") as f:
+      golden = json.load(f)
+  except FileNotFoundError:
+    golden = {}
+
+  all_results = []
+  all_match = True
+
+  print("{:<24}{:>12}{:>12}  {}".format("Micro-benchmark", "us/frame",
+						"frames/s", "output"))
+
+  for name, golden_name, setup in micro_cases():
+
+    if args.select and args.select not in name:
+      continue
+
+    run, output = setup(corpus)
+
+    # Check the output over the whole corpus first
+    digest = hashlib.sha256()
+    for i in range(len(corpus)):
+      digest.update(output(i))
+    digest = digest.hexdigest()
+
+    if args.update_golden and golden.get(golden_name, digest) == digest:
+      golden[golden_name] = digest
+
+    if golden_name not in golden:
+      status = "no golden output"
+      all_match = False
+    elif golden[golden_name] != digest:
+      status = "MISMATCH"
+      all_match = False
+    else:
+      status = "ok"
+
+    # Then time it
+    start = perf_counter()
+    for _ in range(args.repeat):
+      for i in range(len(corpus)):
+        run(i)
+    time_per_frame = (perf_counter() - start) / args.repeat / len(corpus)
+
+    all_results.append({"name": name, "time_per_frame": time_per_frame,
+			"digest": digest, "status": status})
+
+    print("{:<24}{:>12.1f}{:>12.0f}  {}".format(name, time_per_frame * 1e6,
+						1 / time_per_frame, status))
+    sys.stdout.flush()
+
+  if args.update_golden:
+    with open(args.golden, "w") as f:
+      json.dump(golden, f, indent = 2, sort_keys = True)
+      f.write("\n")
+
+  return all_results, all_match
+
+
+
+## Main routine
+#
+
+def main(argv = None):
+
+  # Parse the command line arguments
+  argparser = argparse.ArgumentParser()
+
+  argparser.add_argument(
+	  "record",
+	  help = "Session record (text, GIF or tfr file) whose frames the "
+			"simulated Flipper Zero serves",
+	  type = str,
+	  nargs = "?"
+	)
+
+  argparser.add_argument(
+	  "-m", "--micro",
+	  help = "Run the micro-benchmarks of the hot paths over a fixed "
+			"corpus of frames and check their outputs against the "
+			"golden outputs instead",
+	  action = "store_true"
+	)
+
+  argparser.add_argument(
+	  "-r", "--repeat",
+	  help = "Number of passes over the frame corpus of each "
+			"micro-benchmark. Default: {}".\
+			format(default_micro_repeat),
+	  type = int,
+	  default = default_micro_repeat
+	)
+
+  argparser.add_argument(
+	  "--golden",
+	  help = "JSON file holding the golden outputs of the "
+			"micro-benchmarks. Default: {}".\
+			format(os.path.basename(golden_filename)),
+	  type = str,
+	  default = golden_filename
+	)
+
+  argparser.add_argument(
+	  "--update-golden",
+	  help = "Record the outputs of the micro-benchmarks that don't have "
+			"golden outputs yet as golden outputs",
+	  action = "store_true"
+	)
+
+  argparser.add_argument(
+	  "-l", "--latency",
+	  help = "Screen snapshot latency of the simulated Flipper Zero in "
+			"seconds. Default: 0",
+	  type = float,
+	  default = 0
+	)
+
+  argparser.add_argument(
+	  "-d", "--duration",
+	  help = "Duration of each benchmark session in seconds. Default: {}".\
+			format(default_duration),
+	  type = float,
+	  default = default_duration
+	)
+
+  argparser.add_argument(
+	  "-f", "--fps",
+	  help = "Capture rate passed on to tflipper. Default: {}".\
+			format(default_fps),
+	  type = float,
+	  default = default_fps
+	)
+
+  argparser.add_argument(
+	  "-s", "--screen-stream",
+	  help = "Get the display from the simulated screen stream instead of "
+			"polling screen snapshots",
+	  action = "store_true"
+	)
+
+  argparser.add_argument(
+	  "-k", "--select",
+	  help = "Only run the benchmarks whose name contains this string",
+	  type = str
+	)
+
+  argparser.add_argument(
+	  "--json",
+	  help = "JSON file to save the results into",
+	  type = str
+	)
+
+  argparser.add_argument(
+	  "--run-session",
+	  help = argparse.SUPPRESS,
+	  type = str
+	)
+
+  # The arguments passed on to tflipper in a session child process follow
+  # "--", so the options of the benchmark itself are parsed normally wherever
+  # they are on the command line
+  argv = list(sys.argv[1:] if argv is None else argv)
+  tflipper_args = argv[argv.index("--") + 1:] if "--" in argv else None
+  if tflipper_args is not None:
+    argv = argv[:argv.index("--")]
+
+  args = argparser.parse_args(argv)
+
+  if tflipper_args is not None and not args.run_session:
+    argparser.error("unrecognized arguments: -- {}".\
+			format(" ".join(tflipper_args)))
+
+  if args.latency < 0:
+    argparser.error("the latency must be positive")
+
+  if args.duration <= 0 or args.fps <= 0:
+    argparser.error("the duration and capture rate must be strictly positive")
+
+  if args.repeat < 1:
+    argparser.error("the number of passes must be at least 1")
+
+  # Run the micro-benchmarks and fail if any output doesn't match
+  if args.micro:
+
+    all_results, all_match = run_micro_benchmarks(args)
+
+    if args.json:
+      with open(args.json, "w") as f:
+        json.dump(all_results, f, indent = 2)
+
+    return 0 if all_match else 1
+
+  if args.record is None:
+    argparser.error("a session record is needed to run the benchmarks")
+
+  # Run one session in this child process
+  if args.run_session:
+    run_session(args.run_session, args.record, args.latency,
+			tflipper_args or [])
+    return 0
+
+  if not load_frames(args.record):
+    argparser.error("no frames in {}".format(args.record))
+
+  all_results = []
+
+  with tempfile.TemporaryDirectory() as workdir:
+
+    # Text record holding nothing but the last timecode marker: replaying
+    # button presses from it ends the session after the benchmark's duration
+    end_filename = os.path.join(workdir, "end.txt")
+    with open(end_filename, "w", encoding = "utf-8") as f:
+      f.write(tflipper.CR + tflipper.set_text_invisible + \
+		tflipper.invisible_tc_btn_marker_fmt.format(args.duration,
+								"") + \
+		tflipper.attributes_reset + tflipper.CR + tflipper.LF)
+
+    print("{:<20}{:>12}{:>12}{:>12}{:>10}{:>8}{:>12}".\
+		format("Benchmark", "capture fps", "render fps", "record fps",
+			"CPU", "CPU %", "peak RSS"))
+
+    for density, density_args in densities:
+      for mode, mode_args in modes:
+
+        name = "{} {}".format(density, mode)
+        if args.select and args.select not in name:
+          continue
+
+        tflipper_args = density_args + \
+			[a.format(os.path.join(workdir, "session")) \
+				for a in mode_args] + \
+			["-f", str(args.fps), "--max-fps", str(args.fps),
+				"-rt", end_filename] + \
+			(["-s"] if args.screen_stream else [])
+
+        results = run_benchmark(args, name, tflipper_args, workdir)
+        all_results.append(results)
+
+        print("{:<20}{:>12.1f}{:>12.1f}{:>12.1f}".\
+		format(name, results["captured_fps"], results["rendered_fps"],
+			results["recorded_fps"]) + \
+		("{:>10}{:>8}{:>12}".format("-", "-", "-") \
+			if results["cpu_time"] is None else \
+		"{:>9.2f}s{:>7.0f}%{:>10.1f}MB".\
+			format(results["cpu_time"],
+				results["cpu_time"] * 100 / results["duration"],
+				results["peak_rss"] / 1024 / 1024)))
+        sys.stdout.flush()
+
+  if args.json:
+    with open(args.json, "w") as f:
+      json.dump(all_results, f, indent = 2)
+
+  return 0
+
+
+
+## Main program
+#
+
+if __name__ == "__main__":
+  sys.exit(main())
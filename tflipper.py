@@ -1,21 +1,30 @@
 #!/usr/bin/env python3
 """Flipper Zero remote control for the terminal
-Version: 1.7.1
+Version: 1.8.0
 """
 
 ## Modules
 #
 
+import io
+import os
 import re
 import sys
+import mmap
+import zlib
+import json
+import struct
+import socket
 import argparse
-from time import time
+from time import time, monotonic, perf_counter, sleep
 from copy import copy
+from collections import namedtuple, OrderedDict, deque
 import queue
 import threading
 import multiprocessing
 from readchar import key, readkey
 from flipperzero_protobuf.flipper_proto import FlipperProto
+from flipperzero_protobuf.flipperzero_protobuf_compiled import gui_pb2
 
 try:
   import colorama
@@ -23,7 +32,12 @@ except:
   pass
 
 try:
-  from PIL import Image
+  from PIL import Image, ImageChops, GifImagePlugin
+except:
+  pass
+
+try:
+  import numpy
 except:
   pass
 
@@ -407,6 +421,17 @@ attributes_reset = ESC + "[0m"
 # VT100 x lines up
 x_lines_up = ESC + "[{}A"
 
+# VT100 x lines down
+x_lines_down = ESC + "[{}B"
+
+# Pre-encoded special characters and VT100 sequences for bytes output
+CR_b = CR.encode("ascii")
+LF_b = LF.encode("ascii")
+set_cursor_invisible_b = set_cursor_invisible.encode("ascii")
+set_cursor_visible_b = set_cursor_visible.encode("ascii")
+set_text_invisible_b = set_text_invisible.encode("ascii")
+attributes_reset_b = attributes_reset.encode("ascii")
+
 # Predefined colors
 ansi_8bit_black = 0
 rgb_black1 = [0, 0, 0]
@@ -419,11 +444,107 @@ rgb_orange2 = [0xfe, 0x8a, 0x2d]
 # 4-color palette for the GIF file: color 0 & 2 = orange, color 1 & 3 = black
 gif_palette = rgb_orange1 + rgb_black1 + rgb_orange2 + rgb_black2
 
+# Translation tables from screen data bytes to the color indices of one row of
+# pixels for each bit, and from color indices back to pixels
+gif_bit_tables = [bytes([(v >> j) & 1 for v in range(256)]) for j in range(8)]
+gif_index_to_pixel = bytes([i & 1 for i in range(256)])
+
+# Transparent color added to the palette of GIF files recorded as deltas:
+# color 4 = unchanged pixel
+rgb_transparent = [0xff, 0x00, 0xff]
+gif_transparent_color = 4
+gif_delta_palette = gif_palette + rgb_transparent
+
+# Maximum number of GIF frames being encoded in a process pool at any one time
+gif_max_pending_encodes = 64
+
 # Minimum and maximum duration of one GIF frame
 min_gif_frame_duration_ms = 10 #ms	# because the GIF format encodes the
 max_gif_frame_duration_ms = 655350 #ms	# frame duration in 1/100th of a second
 					# in an unsigned short
 
+# Structure of the messages exchanged with the tflipper daemon over its Unix
+# socket
+daemon_request_fmt = "<cI"	# Request kind, length of the payload
+daemon_reply_fmt = "<cI"	# Status, length of the payload
+
+daemon_device_info = b"I"
+daemon_snapshot = b"S"
+daemon_send_input = b"N"
+
+daemon_ok = b"O"
+daemon_error = b"E"
+
+# Default target and maximum display capture rates
+default_target_fps = 30
+default_max_fps = 60
+
+# Longest interval between two display captures when the display stays idle
+max_idle_capture_interval = 0.5 #s
+
+# How long the display is captured at the target rate after an input event,
+# regardless of whether the display changes
+full_rate_after_input = 1 #s
+
+# How long the replay scheduler spins instead of sleeping before a button
+# press is due, for precise timing
+replay_spin_time = 0.002 #s
+
+# Format of a line of the replay skew log: recorded timecode, actual timecode,
+# skew and button presses
+replay_skew_log_fmt = "{:0.3f}s {:0.3f}s {:+0.1f}ms [{}]\n"
+
+# Flipper Zero keys by button press letter in the short form used in the
+# invisible markers: lowercase for short presses, uppercase for long presses
+button_to_flipper_key = {"L": "LEFT", "D": "DOWN", "U": "UP", "R": "RIGHT",
+				"O": "OK", "B": "BACK"}
+
+# How long the latency probe waits for the display to stay unchanged before
+# sending the next input event, how long it waits for the display to change
+# after an input event by default, and how long it waits for a new frame from
+# the screen stream before checking the timeout again
+probe_settle_time = 0.5 #s
+default_probe_timeout = 2 #s
+probe_poll_interval = 0.01 #s
+
+# How long a screen-synchronized replay waits for the display to match the
+# recorded frame before sending button presses anyway
+default_sync_timeout = 5 #s
+
+# Size of the queues feeding the consumer stages: the display drops frames
+# when it can't keep up, the recorders make the capture stage wait for them
+display_queue_size = 2
+recorder_queue_size = 256
+
+# Maximum number of rendered lines kept in the render caches
+row_render_cache_size = 4096
+
+# Upper bounds of the buckets of the stage latency histograms printed with
+# --stats, and width of the longest histogram bar
+stats_histogram_bounds_ms = (0.1, 0.3, 1, 3, 10, 30, 100, 300, 1000)
+stats_histogram_width = 40
+
+# Mask of bit 0 of every byte of the first line of a GIF image as a big
+# integer, and translation table from GIF color indices to steganographic bits
+steg_bit0_mask = int.from_bytes(b"\x01" * 512, "big")
+steg_index_to_bit = b"00" + b"1" * 254
+
+# Structure of the binary tfr session record files
+tfr_magic = b"TFR1"
+tfr_header_fmt = "<4sH"		# Magic, length of the Flipper's name
+tfr_record_fmt = "<cdHH"	# Kind, timecode, length of the button presses,
+				# length of the payload
+tfr_index_entry_fmt = "<Qdc"	# Record offset, timecode, kind
+tfr_footer_fmt = "<QI4s"	# Index offset, number of frames, index magic
+tfr_index_magic = b"TFRI"
+
+tfr_keyframe = b"K"
+tfr_delta_frame = b"D"
+tfr_end_record = b"E"
+
+# Number of frames between two keyframes in tfr files
+tfr_keyframe_interval = 100
+
 # Format of the invisible timecode and button presses marker
 invisible_tc_btn_marker_fmt = "[{:0.3f}s] [{}]"
 
@@ -433,6 +554,35 @@ re_tc_btn_marker = re.compile((set_text_invisible.replace("[", "\\[") + \
 				r"\[([0-9]+\.[0-9]{3})s\] " \
 				r"\[([lLdDuUrRoObB]*)\]" + \
 				attributes_reset.replace("[", "\\[")))
+re_tc_btn_marker_b = re.compile(re_tc_btn_marker.pattern.encode("ascii"))
+
+# Size of the chunks text session records are read in to parse the invisible
+# markers as they're needed, and size of the overlap between chunks and of the
+# end of the file searched for the last marker
+txt_read_chunk_size = 1024 * 1024
+txt_marker_span = 4096
+
+# Precompiled regex for a x-lines-up sequence, that ends every frame in a text
+# session record
+re_x_lines_up = re.compile(x_lines_up.replace("[", "\\[").\
+				format("[0-9]+").encode("ascii"))
+
+# Precompiled regex for a VT100 attributes sequence
+re_sgr = re.compile(ESC.replace("[", "\\[") + r"\[[0-9;]*m")
+
+# Semigraphic density of a text session record for each rendered display size
+densities_by_size = {(128, 32): "1x2", (64, 22): "2x3", (64, 16): "2x4"}
+
+# Name of the Flipper Zero when it's not recorded in the session record
+default_flipper_name = "[ Flipper Zero ]"
+
+# Number of frames of a text session record sent to each process of the pool
+# at once
+txt_frames_chunk_size = 64
+
+# Renderers used to unrender the frames of text session records in this
+# process, by density
+txt_unrenderers = {}
 
 
 
@@ -454,6 +604,22 @@ class argparse_gif_filename_parser(argparse.Action):
 
 
 
+def semigraphic_keymap_help():
+  """Return the keymap help strings with their box drawing and arrows turned
+  into semigraphic characters
+  """
+
+  return [(" " + l + " ").\
+		replace(" _", " \u250c").replace("_ ", "\u2510 ").\
+		replace("_", "\u2500").replace("|", "\u2502").\
+		replace(" +", " \u2514").replace("+ ", "\u2518 ").\
+		replace("-", "\u2500").replace("<", "\u2190").\
+		replace("^", "\u2191").replace(">", "\u2192").\
+		replace("v", "\u2193")[1:-1]
+		for l in keyboard_to_flipper_help]
+
+
+
 def input_thread(msg_queue):
   """ Get keyboard keypresses, turn them into Flipper Zero input events and send
   them to the main thread
@@ -501,12 +667,18 @@ def steg_encode(image, s):
   are encoded into the image.
   """
 
-  color_transforms = map(lambda c: ((0, 1, 0, 1), (2, 3, 2, 3))[int(c)],
-				("".join(["{:08b}".format(ord(c)) \
-						for c in s]) \
-					+ "0" * 512)[:512])
-  for x in range(512):
-    image.putpixel((x, 0), next(color_transforms)[image.getpixel((x, 0))])
+  # Bits of the string as 512 ASCII "0" or "1" characters
+  bits = ("".join(["{:08b}".format(ord(c)) for c in s]) + "0" * 512)[:512]
+
+  # Work on the first line as a 512-byte big integer: keep bit 0 of each pixel
+  # -orange or black- and replace bit 1 with the bit to encode
+  line = int.from_bytes(image.crop((0, 0, 512, 1)).tobytes(), "big")
+  line = (line & steg_bit0_mask) | \
+		((int.from_bytes(bits.encode("ascii"), "big") & \
+			steg_bit0_mask) << 1)
+
+  image.paste(Image.frombytes("P", (512, 1), line.to_bytes(512, "big")),
+		(0, 0))
 
 
 
@@ -515,13 +687,38 @@ def steg_decode(image, palette):
   line of an image that is 512 wide or wider, with a 4-color palette
   """
 
+  try:
+
+    line = image.crop((0, 0, 512, 1)).tobytes()
+
+    # Palette image: translate the color indices of the first line directly
+    # into ASCII "0" or "1" bits
+    if image.mode == "P":
+      bits = line.translate(steg_index_to_bit)
+
+    # RGB image: look up the colors of the first line in the palette
+    else:
+      rgb_to_bit = {rgb: b"0" if i < 2 else b"1" for rgb, i in palette.items()}
+      bits = b"".join(map(rgb_to_bit.__getitem__,
+				zip(line[0::3], line[1::3], line[2::3])))
+
+  except:
+    return ""
+
+  return steg_decode_bits(bits)
+
+
+
+def steg_decode_bits(bits):
+  """ Decode a hidden string from the 512 bits of the first line of an image
+  encoded by the steg_encode() function, as ASCII "0" or "1" characters
+  """
+
   s = ""
 
   try:
 
-    for x in range(0, 512, 8):
-      c = chr(sum([(0 if palette[image.getpixel((x + o, 0))] < 2 else 1) << \
-			(7 - o) for o in range(8)]))
+    for c in int(bits, 2).to_bytes(64, "big").decode("latin-1"):
       if not c.isprintable() and c != ESC:
         break
       s += c
@@ -533,483 +730,3729 @@ def steg_decode(image, palette):
 
 
 
-## Main routine
-#
+gif_frame = namedtuple("gif_frame", ("data_pos", "left", "top", "width",
+					"height", "color_table", "transparency",
+					"disposal"))
 
-def main():
+def gif_index(data):
+  """Walk through the blocks of a GIF file without decoding any image data.
+  Return the logical screen size, the global color table as a list of RGB
+  tuples, the background color index and the list of frames
+  """
 
-  # If we run on Windows, initialize colorama, so the Windows console
-  # understands ANSI escape codes
-  if sys.platform[0:3] == "win":
-    colorama.init()
+  assert data[:6] in (b"GIF87a", b"GIF89a")
 
-  # Parse the command line arguments
-  argparser = argparse.ArgumentParser()
+  width, height, flags, background = struct.unpack_from("<HHBB", data, 6)
+  i = 13
 
-  argparser.add_argument(
-	  "-d", "--device",
-	  help = "Flipper Zero serial device to use. Default: autodetect",
-	  type = str
-	)
+  def color_table(i, flags):
+    """Return the color table following a block whose flags are passed, and
+    the position after it
+    """
+    if not flags & 0x80:
+      return None, i
+    size = 3 << ((flags & 7) + 1)
+    return [tuple(data[j : j + 3]) for j in range(i, i + size, 3)], i + size
 
-  argparser.add_argument(
-	  "-M", "--mid-density-semigraphics",
-	  help = "Use 2x3 unicode block characters for rendering (smaller "
-			"console needed but incorrect aspect ratio). "
-			"Default: 1x2 unicode block characters",
-	  action = "store_true"
-	)
+  def skip_sub_blocks(i):
+    """Return the position after the data sub-blocks starting at i
+    """
+    while data[i]:
+      i += data[i] + 1
+    return i + 1
 
-  argparser.add_argument(
-	  "-H", "--high-density-semigraphics",
-	  help = "Use 2x4 unicode Braille characters for rendering (smaller "
-			"console needed but uses dots instead of full pixels). "
-			"Default: 1x2 unicode block characters",
-	  action = "store_true"
-	)
+  global_color_table, i = color_table(i, flags)
 
-  argparser.add_argument(
-	  "-B", "--bold",
-	  help = "Display semigraphic characters in bold",
-	  action = "store_true"
-	)
+  frames = []
+  transparency = None
+  disposal = 0
 
-  argparser.add_argument(
-	  "-t", "--txt",
-	  help = "Text file to record the session into (play it back with "
-			"tfreplay or replay button presses encoded into it "
-			"with -r)",
-	  type = str
-	)
+  while i < len(data) and data[i] != 0x3b:
 
-  argparser.add_argument(
-	  "-g", "--gif",
-	  help = "Animated GIF to record the session into",
-	  action = argparse_gif_filename_parser
-	)
+    # Extension: only the graphic control extension is of interest
+    if data[i] == 0x21:
+      if data[i + 1] == 0xf9:
+        flags, _, transparent_color = struct.unpack_from("<BHB", data, i + 3)
+        transparency = transparent_color if flags & 1 else None
+        disposal = (flags >> 2) & 7
+      i = skip_sub_blocks(i + 2)
 
-  mutexargs = argparser.add_mutually_exclusive_group(required = False)
+    # Image descriptor followed by an optional local color table and the image
+    # data
+    elif data[i] == 0x2c:
+      left, top, w, h, flags = struct.unpack_from("<HHHHB", data, i + 1)
+      local_color_table, i = color_table(i + 10, flags)
+      frames.append(gif_frame(i, left, top, w, h, local_color_table,
+				transparency, disposal))
+      i = skip_sub_blocks(i + 1)
 
-  mutexargs.add_argument(
-	  "-rt", "--replay-buttons-from-txt",
-	  help = "Text file session recording to replay button presses from "
-			"(generated by -t)",
-	  type = str
-	)
+      # The graphic control extension only applies to the next image
+      transparency = None
+      disposal = 0
 
-  mutexargs.add_argument(
-	  "-rg", "--replay-buttons-from-gif",
-	  help = "GIF file session recording to replay button presses from "
-			"(generated by -g)",
-	  type = str
-	)
+    else:
+      raise ValueError("invalid GIF block 0x{:02x} at offset {}".
+				format(data[i], i))
 
-  argparser.add_argument(
-	  "-n", "--no-display",
-	  help = "Suppress the display output, only print button presses",
-	  action = "store_true"
-	)
+  return (width, height), global_color_table, background, frames
 
-  args = argparser.parse_args()
 
-  # Semigraphic-ize the keymap help strings
-  keymap_help = [(" " + l + " ").\
-			replace(" _", " \u250c").replace("_ ", "\u2510 ").\
-			replace("_", "\u2500").replace("|", "\u2502").\
-			replace(" +", " \u2514").replace("+ ", "\u2518 ").\
-			replace("-", "\u2500").replace("<", "\u2190").\
-			replace("^", "\u2191").replace(">", "\u2192").\
-			replace("v", "\u2193")[1:-1]
-			for l in keyboard_to_flipper_help]
 
-  width = 64 if args.high_density_semigraphics or \
-		args.mid_density_semigraphics else 128
+def gif_decode_first_pixels(data, i, nb_pixels):
+  """Decode the LZW-compressed image data starting at position i in a GIF
+  file only until the first nb_pixels pixels are decoded, and return the
+  color indices of those pixels
+  """
 
-  height = 16 if args.high_density_semigraphics else \
-		22 if args.mid_density_semigraphics else 32
+  min_code_size = data[i]
+  clear_code = 1 << min_code_size
+  end_code = clear_code + 1
+  i += 1
+  block_end = i
+
+  code_size = min_code_size + 1
+  code_mask = (1 << code_size) - 1
+  table = [bytes([c]) for c in range(clear_code)] + [b"", b""]
+  prev_entry = None
+
+  bit_buffer = 0
+  nb_bits = 0
+
+  pixels = bytearray()
+
+  while len(pixels) < nb_pixels:
+
+    # Get enough bits from the data sub-blocks for the next code
+    while nb_bits < code_size:
+      if i == block_end:
+        if not data[i]:
+          return bytes(pixels)
+        block_end = i + 1 + data[i]
+        i += 1
+      bit_buffer |= data[i] << nb_bits
+      nb_bits += 8
+      i += 1
+
+    code = bit_buffer & code_mask
+    bit_buffer >>= code_size
+    nb_bits -= code_size
+
+    if code == clear_code:
+      code_size = min_code_size + 1
+      code_mask = (1 << code_size) - 1
+      del table[clear_code + 2:]
+      prev_entry = None
+      continue
+
+    if code == end_code:
+      break
+
+    if code < len(table):
+      entry = table[code]
+      if prev_entry is not None and len(table) < 4096:
+        table.append(prev_entry + entry[:1])
+    elif code == len(table) and prev_entry is not None:
+      entry = prev_entry + prev_entry[:1]
+      table.append(entry)
+    else:
+      raise ValueError("invalid LZW code")
+
+    pixels += entry
+    prev_entry = entry
+
+    if len(table) == code_mask + 1 and code_size < 12:
+      code_size += 1
+      code_mask = (1 << code_size) - 1
+
+  return bytes(pixels[:nb_pixels])
+
+
+
+def gif_decode_first_lines(filename, frames):
+  """Decode the first line of each frame of a GIF file passed as (image data
+  position, width) tuples. Runs in a separate process when the work is split
+  across a process pool
+  """
 
-  extra_attributes = attribute_bold if args.bold else ""
+  with open(filename, "rb") as f:
+    with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as data:
+      return [gif_decode_first_pixels(data, i, w) for i, w in frames]
 
-  keymap_help_line_len = len(keymap_help[0])
-  keymap_help_overlay_at_col = int((width - keymap_help_line_len) / 2)
-  keymap_help_overlay_at_line = int((height - len(keymap_help)) / 2)
 
-  # If a text file to replay button presses from was specified, load it and
-  # extract the button press events from it
-  if args.replay_buttons_from_txt:
-    with open(args.replay_buttons_from_txt, "r") as f:
-      replay_buttons_at = [(float(t), b) \
-				for t, b in re_tc_btn_marker.findall(f.read())]
 
-  # If a GIF file to replay button presses from was specified, load it and
-  # extract the button press events from it
-  elif args.replay_buttons_from_gif:
+def gif_first_lines(filename, nb_processes = 1):
+  """Generator returning the color indices of the first line of the animated
+  GIF's logical screen as each frame is displayed, only decoding the first
+  line of the frames that cover it. The decoding is split across a process
+  pool if more than one process is requested. Color indices of frames with a
+  local color table are mapped to the global color table
+  """
 
-    with Image.open(args.replay_buttons_from_gif) as gif:
-      assert gif.is_animated
-      assert gif.size == (512, 256)
-      assert len(gif.palette.colors) == 4
+  with open(filename, "rb") as f:
+    with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as data:
+      size, global_color_table, background, frames = gif_index(data)
+
+  assert global_color_table is not None
+
+  # Frames covering the first line and their first line
+  first_line_frames = [(frame.data_pos, frame.width) for frame in frames \
+				if frame.top == 0 and frame.left < size[0]]
+
+  # Decode the first line of the frames covering it, in chunks of contiguous
+  # frames spread across the process pool if requested
+  if nb_processes > 1 and len(first_line_frames) > nb_processes:
+    chunk_size = -(-len(first_line_frames) // nb_processes)
+    chunks = [first_line_frames[i : i + chunk_size] \
+		for i in range(0, len(first_line_frames), chunk_size)]
+    with multiprocessing.Pool(nb_processes) as pool:
+      first_lines = [first_line for chunk in pool.starmap(
+					gif_decode_first_lines,
+					[(filename, c) for c in chunks]) \
+				for first_line in chunk]
+  else:
+    first_lines = gif_decode_first_lines(filename, first_line_frames)
 
-      palette = gif.palette.colors
+  first_lines = iter(first_lines)
 
-      replay_buttons_at = []
-      for frame in range(gif.n_frames):
-        gif.seek(frame)
-        s = steg_decode(gif if gif.mode == "RGB" else gif.convert("RGB"),
-			palette)
-        replay_buttons_at.extend([(float(t), b) \
-				for t, b in re_tc_btn_marker.findall(s)])
+  # Compose the first line of the logical screen frame after frame
+  line = bytearray([background]) * size[0]
 
-  # No text file or GIF file to replay button presses from
-  else:
-    replay_buttons_at = None
+  for frame in frames:
 
-  # If we replay button presses, prune empty button presses apart from the last
-  # one that marks the end of the replay
-  if replay_buttons_at is not None:
-    replay_buttons_at = [e for e in replay_buttons_at[:-1] if e[1]] + \
-			replay_buttons_at[-1:]
+    if frame.top != 0 or frame.left >= size[0]:
+      yield bytes(line)
+      continue
 
-  # Connect to the Flipper Zero
-  p = FlipperProto(serial_port = args.device)
+    pixels = next(first_lines)[:size[0] - frame.left]
+    prev_line = bytes(line)
 
-  # Get the Flipper Zero's name
-  flipper_name = "[ " + p.device_info["hardware_name"] + " ]"
+    # Map local color table indices to global color table indices
+    if frame.color_table is not None:
+      global_indices = {rgb: i for i, rgb in \
+				reversed(list(enumerate(global_color_table)))}
+      mapping = bytes([global_indices.get(rgb, 0) \
+				for rgb in frame.color_table]).ljust(256, b"\0")
+    else:
+      mapping = None
 
-  # Left and right spacers for the Flipper Zero's name
-  len_flipper_name_spc1 = int((width - len(flipper_name)) / 2)
-  flipper_name_spc2 = " " * (width - len_flipper_name_spc1 - len(flipper_name))
+    if mapping is None and (frame.transparency is None or \
+				frame.transparency not in pixels):
+      line[frame.left : frame.left + len(pixels)] = pixels
+    else:
+      for x, c in enumerate(pixels, frame.left):
+        if c != frame.transparency:
+          line[x] = mapping[c] if mapping else c
 
-  # Bottom help line
-  bottom_line = ("[ Ctrl-K to show/hide keymap ]     " \
-				if replay_buttons_at is None else "") + \
-			"[ Ctrl-C to stop ]"
+    yield bytes(line)
 
-  # Left and right spacers for the bottom help line
-  bottom_line_spc1 = " " * int((width - len(bottom_line)) / 2)
-  bottom_line_spc2 = " " * (width - len(bottom_line_spc1) - len(bottom_line))
+    # Dispose of the frame
+    if frame.disposal == 2:
+      line[frame.left : frame.left + len(pixels)] = \
+				bytes([background]) * len(pixels)
+    elif frame.disposal == 3:
+      line[:] = prev_line
 
-  # Create a queue for the input thread to send messages to the main thread
-  q = multiprocessing.Queue()
 
-  # Spawn the input thread to get keypresses if we don't replay button presses
-  if replay_buttons_at is None:
-    t = threading.Thread(target = input_thread, args = (q,))
-    t.start()
 
-  # Open the text file if the session is recorded in a text file
-  rt = open(args.txt, "w", encoding = "utf-8") if args.txt else None
+def gif_encode_image(image):
+  """Encode a palette image on its own as a GIF with Pillow and return its
+  width, height and image data -LZW minimum code size and LZW-compressed data
+  sub-blocks- so it can be appended to another GIF file
+  """
 
-  # Create a list of frames and durations if the session is recorded in a GIF
-  gif_frames = [] if args.gif else None
-  gif_frame_durations_ms = [] if args.gif else None
+  f = io.BytesIO()
+  image.save(f, format = "GIF", optimize = False, interlace = False)
+  data = f.getbuffer()
 
-  gif_frame_no = 0
+  # Skip the header, the logical screen descriptor and the global color table
+  i = 13
+  if data[10] & 0x80:
+    i += 3 << ((data[10] & 7) + 1)
 
-  nb_lines_back_up = 0
-  nb_lines_back_up_text_record = 0
+  # Skip the extensions up to the image descriptor
+  while data[i] == 0x21:
+    i += 2
+    while data[i]:
+      i += data[i] + 1
+    i += 1
 
-  cursor_visible = True
-  show_keymap = False
+  assert data[i] == 0x2c
+  width, height = struct.unpack_from("<HH", data, i + 5)
 
-  start_time = None
+  # Skip the image descriptor and the local color table if there is one
+  flags = data[i + 9]
+  i += 10
+  if flags & 0x80:
+    i += 3 << ((flags & 7) + 1)
 
-  screen_data = b""
-  update_display = True
+  # Get the LZW minimum code size and the data sub-blocks up to the terminator
+  j = i + 1
+  while data[j]:
+    j += data[j] + 1
+  j += 1
 
-  try:
+  image_data = bytes(data[i : j])
+  del data
 
-    # Run until stopped by Ctrl-C
-    while True:
+  return width, height, image_data
 
-      flipper_inputs = ""
 
-      # Process messages from the input thread
-      while True:
 
-        # Try to get one message out of the queue
-        try:
-          flipper_input, e = q.get_nowait()
+class gif_stream_writer:
+  """Write an animated GIF file incrementally: the file header is written on
+  creation and each frame is appended to the file as soon as it's written, so
+  only the frame being written is ever held in memory.
 
-        except queue.Empty:
-          break
+  If a process pool is passed, the frames are encoded in the pool and
+  appended to the file in order as their encoding completes, with a limited
+  number of frames being encoded at any one time.
+  """
 
-        # If we got an exception from the input thread, re-raise it
-        if e is not None:
-          raise e
+  def __init__(self, filename, size, palette, loop = 0, pool = None):
+    """__init__ method. The palette is a flat list of RGB values
+    """
 
-        # Do we have a Flipper Zero input event string?
-        elif flipper_input is not None:
+    self.f = open(filename, "wb")
 
-          # Should we show or hide the keymap?
-          if flipper_input == "k":
+    self.pool = pool
+    self.pending_frames = deque()
 
-            show_keymap = not show_keymap
-            update_display = True
+    # Pad the palette to a power of 2 number of colors, 2 at least
+    nb_colors_bits = max((len(palette) // 3 - 1).bit_length(), 1)
+    palette_bytes = bytes(palette).ljust(3 << nb_colors_bits, b"\0")
 
-          # If the string isn't empty, send the event to the Flipper Zero and
-          # store them for recording in the session text file in short form
-          elif flipper_input:
-            p.rpc_gui_send_input(flipper_input)
-            i1, i2 = flipper_input.split()
-            flipper_inputs += i2[0].lower() if i1 == "SHORT" else i2[0].upper()
+    # Header, logical screen descriptor with a global color table, the global
+    # color table and the Netscape looping application extension
+    self.f.write(b"GIF89a" + \
+		struct.pack("<HHBBB", size[0], size[1],
+				0x80 | ((nb_colors_bits - 1) << 4) | \
+					(nb_colors_bits - 1), 0, 0) + \
+		palette_bytes + \
+		b"!\xff\x0bNETSCAPE2.0\x03\x01" + struct.pack("<H", loop) + \
+		b"\0")
 
-        # The input thread exited normally so do the same thing
-        else:
-          raise KeyboardInterrupt
 
-      # Get the current time and calculate the current timecode
-      now = time()
-      if start_time is None:
-        start_time = now
-      timecode = now - start_time
-      if timecode < 0:
-        timecode = 0
 
-      # Do we replay button presses?
-      if replay_buttons_at is not None:
+  def write_encoded_frame(self, encoded_image, duration_ms, offset = (0, 0),
+				transparency = None, disposal = 0):
+    """Append an image encoded by gif_encode_image() as a frame lasting
+    duration_ms milliseconds, at the given offset, with the given transparent
+    color index if any and the given disposal method
+    """
 
-        # If there are no buttons left to replay, stop as if the user hit Ctrl-C
-        if not replay_buttons_at:
-          raise KeyboardInterrupt
+    width, height, image_data = encoded_image
 
-        # If we're due to replay Flipper Zero button presses, add them to the
-        # inputs and replay them
-        while replay_buttons_at and timecode >= replay_buttons_at[0][0]:
+    # Graphic control extension, image descriptor and image data
+    self.f.write(b"!\xf9\x04" + \
+		struct.pack("<BHBB",
+				(disposal << 2) | (transparency is not None),
+				int(duration_ms / 10), transparency or 0, 0) + \
+		b"," + struct.pack("<HHHHB",
+				offset[0], offset[1], width, height, 0) + \
+		image_data)
 
-          _, btns = replay_buttons_at.pop(0)
-          flipper_inputs += btns
+    # Flush the frame so it makes it to the file even if we crash later
+    self.f.flush()
 
-          # Send the button press events to the Flipper Zero
-          for b in btns:
-            p.rpc_gui_send_input(("SHORT " if b.islower() else "LONG ") + \
-					{"L": "LEFT", "D": "DOWN", "U": "UP",
-						"R": "RIGHT", "O": "OK",
-						"B": "BACK"}[b.upper()])
 
-      # Get a screenshot from the Flipper Zero
-      prev_screen_data = screen_data
-      screen_data = p.rpc_gui_snapshot_screen()
-      assert len(screen_data) == 1024
-      screen_data_changed = screen_data != prev_screen_data
 
-      # If the Flipper's display hasn't changed and no input was sent to the
-      # Flipper, there is nothing more to do with this frame
-      if not screen_data_changed and not update_display and not flipper_inputs:
-        continue
+  def write_frame(self, image, duration_ms, offset = (0, 0),
+			transparency = None, disposal = 0):
+    """Append a palette image as a frame lasting duration_ms milliseconds
+    """
 
-      # Do we record GIF frames and do we have a reason to record this frame?
-      if gif_frames is not None and (screen_data_changed or flipper_inputs):
-
-        # Is there at least one stored GIF frame?
-        if gif_frames:
-
-          # The difference between this timecode and the previous GIF frame's
-          # timecode is the previous GIF frame's duration
-          prev_frame_duration_ms = (timecode - last_gif_frame_timecode) * 1000
-
-          # Repeat the previous GIF frame as many times as needed, encode only
-          # the frame number invisibly into the image then increment the
-          # frame number
-          while prev_frame_duration_ms > max_gif_frame_duration_ms + \
-						min_gif_frame_duration_ms:
-            image = copy(gif_frames[-1])
-            steg_encode(image, "{}".format(gif_frame_no))
-            gif_frame_no += 1
-            gif_frame_durations_ms.append(max_gif_frame_duration_ms)
-            gif_frames.append(image)
-            prev_frame_duration_ms -= max_gif_frame_duration_ms
-
-          # Add the duration of the last GIF frame
-          gif_frame_durations_ms.append(max(prev_frame_duration_ms,
-						min_gif_frame_duration_ms))
-
-        # Convert the Flipper's screen data into an image and scale it up x4
-        image_data = bytes([(screen_data[i] >> j) & 1 \
-				for k in range(0, 1024, 128) \
-				for j in range(8) \
-				for i in range(k, k + 128)])
-        image = Image.frombytes(mode = "P", size = (128, 64),
-				data = image_data).\
-				resize((512, 256), resample = Image.BOX)
-        image.putpalette(gif_palette)
-
-        # Encode the frame number, timecode and flipper inputs invisibly into
-        # the image then increment the frame number
-        steg_encode(image, "[{}] ".format(gif_frame_no) + \
-				set_text_invisible + \
-				invisible_tc_btn_marker_fmt.
-					format(timecode, flipper_inputs) + \
-				attributes_reset)
-        gif_frame_no += 1
-
-        # Add the image to the GIF frames
-        gif_frames.append(image)
-        last_gif_frame_timecode = timecode
-
-      # Hide the cursor if needed
-      if not args.no_display and cursor_visible:
-        sys.stdout.write(set_cursor_invisible)
-        cursor_visible = False
-
-      # Turn the screen data into lines of unicode elements
-      if args.high_density_semigraphics:
-        imglines = ["".join([unicode_braille_2x4[((screen_data[i] >> j) & \
-							0b1111) | \
-						(((screen_data[i + 1] >> j) & \
-							0b1111) << 4)]
-				for i in range(k, k + 128, 2)])
-			for k in range(0, 1024, 128) for j in (0, 4)]
-
-      elif args.mid_density_semigraphics:
-
-        imglines = []
-        for k in range(0, 1024, 384):
-
-          c = [screen_data[i] + (screen_data[i + 128] << 8) + \
-		((screen_data[i + 256] << 16) if i < 768 else 0xff0000) \
-		for i in range(k, k + 128)]
-
-          for j in (0, 3, 6, 9, 12, 15) + ((18, 21) if k < 768 else ()):
-            imglines.append("".join([unicode_blocks_2x3[
-						((c[i] >> j) & 7) | \
-						(((c[i + 1] >> j) & 7) << 3)] \
-					for i in range(0, 128, 2)]))
+    if self.pool is None:
+      self.write_encoded_frame(gif_encode_image(image), duration_ms, offset,
+				transparency, disposal)
+      return
 
-      else:
-        imglines = ["".join([unicode_blocks_1x2[(screen_data[i] >> j) & 0b11]
-				for i in range(k, k + 128)])
-			for k in range(0, 1024, 128) for j in (0, 2, 4, 6)]
-
-      # Encode the invisible timecode and button presses marker into the left
-      # spacer for the Flipper Zero's name
-      tcbtns = invisible_tc_btn_marker_fmt.format(timecode, flipper_inputs)
-      flipper_name_spc1 = set_text_invisible + tcbtns + attributes_reset + \
-				" " * (len_flipper_name_spc1 - len(tcbtns))
-
-      # Do we record the session in a text file and do we have a reason to
-      # record this frame?
-      if rt is not None and (screen_data_changed or flipper_inputs):
-
-        # Generate the ANSI text for the record without help overlay or bottom
-        # help line
-        at = flipper_name_spc1 + flipper_name + flipper_name_spc2 + CR + LF + \
-		"".join([set_bg_color.format(ansi_8bit_black) + \
-				set_fg_color.format(ansi_8bit_orange) + \
-				extra_attributes + l + attributes_reset + \
-				CR + LF \
-				for l in imglines]) + \
-		x_lines_up.format(height + 1)
+    self.pending_frames.append((self.pool.apply_async(gif_encode_image,
+							(image,)),
+				duration_ms, offset, transparency, disposal))
+    self.write_pending_frames(gif_max_pending_encodes)
 
-        # Save the ANSI text into the file
-        rt.write(at)
-        nb_lines_back_up_text_record = height + 1
 
-      # Should we update the display?
-      if screen_data_changed or update_display or flipper_inputs:
 
-        # Is the normal display output suppressed?
-        if args.no_display:
+  def write_pending_frames(self, max_pending_frames = 0):
+    """Wait for the frames being encoded in the process pool and append them
+    until at most max_pending_frames are left
+    """
 
-          # Print the timecode and keypresses
-          for b in flipper_inputs:
-            print("[{:0.3f}s] {}{}".
-			format(timecode,
-				{"L": "\u2190", "D": "\u2193",
-					"U": "\u2191", "R": "\u2192",
-					 "O": "o", "B": "\u21B0"}[b.upper()],
-				"" if b.islower() else " (long press)"))
+    while len(self.pending_frames) > max_pending_frames:
+      encoded_image, *frame_args = self.pending_frames.popleft()
+      self.write_encoded_frame(encoded_image.get(), *frame_args)
 
-        # Output the normal display
-        else:
 
-          # If the keymap help should be displayed, overlay it over the lines
-          if show_keymap:
-            for i, l in enumerate(keymap_help):
-              imglines[keymap_help_overlay_at_line + i] = \
-				imglines[keymap_help_overlay_at_line + i]\
-					[:keymap_help_overlay_at_col] + \
-				attributes_reset + l + \
-				set_bg_color.format(ansi_8bit_black) + \
-				set_fg_color.format(ansi_8bit_orange) + \
-				extra_attributes + \
-				imglines[keymap_help_overlay_at_line + i]\
-					[keymap_help_overlay_at_col + \
-						keymap_help_line_len:]
-
-          # Generate the display ANSI text with help overlay & bottom help line
-          at = flipper_name_spc1 + flipper_name + flipper_name_spc2 + \
-		CR + LF + \
-		"".join([set_bg_color.format(ansi_8bit_black) + \
-				set_fg_color.format(ansi_8bit_orange) + \
-				extra_attributes + l + attributes_reset + \
-				CR + LF \
-				for l in imglines]) + \
-		bottom_line_spc1 + bottom_line + bottom_line_spc2 + \
-		x_lines_up.format(1) + CR + LF + x_lines_up.format(height + 1)
 
-          # Print the ANSI text & flush the console so it's updated immediately
-          sys.stdout.write(at)
-          sys.stdout.flush()
-          nb_lines_back_up = height + 1
+  def close(self):
+    """Write the pending frames and the trailer, and close the file
+    """
 
-          update_display = False
+    self.write_pending_frames()
+
+    self.f.write(b";")
+    self.f.close()
+
+
+
+class screen_snapshot_poller:
+  """Get the Flipper Zero's display by requesting one screen snapshot at a time
+  """
+
+  def __init__(self, proto):
+    """__init__ method
+    """
+
+    self.proto = proto
+
+    # Lock serializing the RPC requests sent to the Flipper Zero
+    self.lock = threading.Lock()
+
+
+
+  def start(self):
+    """Nothing to start when polling
+    """
 
-  except KeyboardInterrupt:
     pass
 
-  except:
-    raise
 
-  finally:
 
-    # Get the current time and calculate this last output's timecode
-    now = time()
-    if start_time is None:
-      start_time = now
-    timecode = now - start_time
+  def stop(self):
+    """Nothing to stop when polling
+    """
 
-    # If GIF frames are recorded and we have at least one frame, set this last
-    # timecode as the final GIF frame's duration
-    if gif_frames:
+    pass
 
-      # The difference between this timecode and the previous GIF frame's
-      # timecode is the previous GIF frame's duration
-      prev_frame_duration_ms = (timecode - last_gif_frame_timecode) * 1000
 
-      # Repeat the previous GIF frame as many times as needed, encode only the
-      # frame number invisibly into the image then increment the frame number
-      while prev_frame_duration_ms > max_gif_frame_duration_ms + \
-					min_gif_frame_duration_ms:
-        image = copy(gif_frames[-1])
-        steg_encode(image, "[{}]".format(gif_frame_no))
-        gif_frame_no += 1
-        gif_frame_durations_ms.append(max_gif_frame_duration_ms)
-        gif_frames.append(image)
-        prev_frame_duration_ms -= max_gif_frame_duration_ms
-
-      # Add the duration of the final GIF frame
-      gif_frame_durations_ms.append(max(prev_frame_duration_ms,
-						min_gif_frame_duration_ms))
-
-    # If we output the normal display, output the last invisible timecode and
-    # button presses marker then skip past the rendering
-    if not args.no_display:
-      sys.stdout.write(CR + set_text_invisible + \
-			invisible_tc_btn_marker_fmt.
-				format(timecode, flipper_inputs) + \
-			attributes_reset + CR + LF * (nb_lines_back_up + 1))
 
-    # If we record the session into a text file, output the same thing into it
-    if rt is not None:
-      rt.write(CR + set_text_invisible + \
-		invisible_tc_btn_marker_fmt.
-			format(timecode, flipper_inputs) + \
-		attributes_reset + CR + LF * (nb_lines_back_up_text_record + 1))
+  def get_frame(self, timeout = None):
+    """Take a snapshot of the Flipper Zero's display and return its 1024 bytes
+    of screen data
+    """
+
+    with self.lock:
+      return self.proto.rpc_gui_snapshot_screen()
 
-    # Show the cursor again if needed
-    if not cursor_visible:
-      sys.stdout.write(set_cursor_visible)
+
+
+  def send_input(self, flipper_input):
+    """Send an input event string (e.g. "SHORT LEFT") to the Flipper Zero
+    """
+
+    with self.lock:
+      self.proto.rpc_gui_send_input(flipper_input)
+
+
+
+class screen_stream_reader:
+  """Get the Flipper Zero's display from its screen stream: once the stream is
+  started, the Flipper Zero pushes a new frame every time its display is
+  redrawn.
+
+  While the stream is active, the reader thread is the only one reading from
+  the serial link: input events are sent without waiting for their answers,
+  which the reader thread reads and discards along with anything else that
+  isn't a screen frame.
+
+  Only rpc_gui_start_screen_stream(), _rpc_read_any() and _rpc_send() are used
+  on the FlipperProto object, so a stand-in pushing canned frames can be used
+  in its place.
+
+  If on_frame is set, it is called from the reader thread every time a new
+  frame is pushed.
+  """
+
+  def __init__(self, proto, on_frame = None):
+    """__init__ method
+    """
+
+    self.proto = proto
+    self.on_frame = on_frame
+
+    # Lock serializing the RPC requests sent to the Flipper Zero
+    self.send_lock = threading.Lock()
+
+    # Latest frame pushed by the Flipper Zero, its sequence number and the
+    # sequence number of the last frame returned by get_frame()
+    self.frame_cond = threading.Condition()
+    self.frame = None
+    self.frame_seq = 0
+    self.frame_seq_returned = 0
+
+    # Exception raised in the reader thread, to re-raise in the main thread
+    self.exception = None
+
+    self.thread = None
+
+
+
+  def start(self):
+    """Start the screen stream and the reader thread
+    """
+
+    self.proto.rpc_gui_start_screen_stream()
+
+    self.thread = threading.Thread(target = self.reader_thread, daemon = True)
+    self.thread.start()
+
+
+
+  def stop(self):
+    """Stop the screen stream and the reader thread
+    """
+
+    if self.thread is None:
+      return
+
+    setattr(self.thread, "do_run", False)
+
+    # Ask the Flipper Zero to stop the stream without waiting for the answer:
+    # the reader thread reads it and exits
+    try:
+      with self.send_lock:
+        self.proto._rpc_send(gui_pb2.StopScreenStreamRequest(),
+				"gui_stop_screen_stream_request")
+    except:
+      pass
+
+    self.thread.join(timeout = 1)
+    self.thread = None
+
+
+
+  def reader_thread(self):
+    """Read messages from the Flipper Zero and keep the latest screen frame
+    """
+
+    t = threading.current_thread()
+
+    try:
+
+      # Run until we're told to stop
+      while getattr(t, "do_run", True):
+
+        data = self.proto._rpc_read_any()
+
+        # Screen frames are sent unsolicited with command ID 0
+        if data.command_id == 0 and data.HasField("gui_screen_frame"):
+          with self.frame_cond:
+            self.frame = data.gui_screen_frame.data
+            self.frame_seq += 1
+            self.frame_cond.notify_all()
+
+          if self.on_frame is not None:
+            self.on_frame()
+
+    except Exception as e:
+      with self.frame_cond:
+        self.exception = e
+        self.frame_cond.notify_all()
+
+
+
+  def get_frame(self, timeout = None):
+    """Wait until the Flipper Zero pushes a new frame or the timeout expires
+    and return the latest 1024 bytes of screen data. Block until the first
+    frame is received regardless of the timeout.
+    """
+
+    with self.frame_cond:
+
+      self.frame_cond.wait_for(lambda: self.exception is not None or \
+				self.frame_seq > self.frame_seq_returned,
+				timeout = timeout)
+
+      while self.exception is None and self.frame is None:
+        self.frame_cond.wait()
+
+      # If the reader thread died, re-raise its exception
+      if self.exception is not None:
+        raise self.exception
+
+      self.frame_seq_returned = self.frame_seq
+      return self.frame
+
+
+
+  def send_input(self, flipper_input):
+    """Send an input event string (e.g. "SHORT LEFT") to the Flipper Zero as
+    press, short or long, and release events
+    """
+
+    input_type, input_key = flipper_input.split()
+
+    with self.send_lock:
+      for t in ("PRESS", input_type, "RELEASE"):
+        cmd_data = gui_pb2.SendInputEventRequest()
+        cmd_data.key = getattr(gui_pb2, input_key)
+        cmd_data.type = getattr(gui_pb2, t)
+        self.proto._rpc_send(cmd_data, "gui_send_input_event_request")
+
+
+
+def default_daemon_socket():
+  """Return the default path of the tflipper daemon's Unix socket for this
+  user, or None if the platform doesn't have Unix sockets
+  """
+
+  if not hasattr(socket, "AF_UNIX") or not hasattr(os, "getuid"):
+    return None
+
+  return os.path.join(os.environ.get("XDG_RUNTIME_DIR") or "/tmp",
+			"tflipper-{}.sock".format(os.getuid()))
+
+
+
+def recv_message(sock, fmt):
+  """Receive a message made of a header with the given structure, ending with
+  the length of the payload, followed by the payload. Return the header's
+  first field and the payload, or None if the connection was closed before
+  the message
+  """
+
+  def recv_exactly(n):
+    data = b""
+    while len(data) < n:
+      chunk = sock.recv(n - len(data))
+      if not chunk:
+        if data:
+          raise ConnectionError("connection closed in the middle of a message")
+        return None
+      data += chunk
+    return data
+
+  header = recv_exactly(struct.calcsize(fmt))
+  if header is None:
+    return None
+
+  kind, payload_len = struct.unpack(fmt, header)
+  payload = recv_exactly(payload_len) if payload_len else b""
+  if payload is None:
+    raise ConnectionError("connection closed in the middle of a message")
+
+  return kind, payload
+
+
+
+class flipper_daemon:
+  """Keep one connection to the Flipper Zero open and serve the device
+  information, screen snapshots and input events to tflipper clients over a
+  Unix socket, so they don't have to connect to the Flipper Zero themselves.
+  Each client is served from a thread of its own, and the requests of all the
+  clients are serialized over the connection to the Flipper Zero
+  """
+
+  def __init__(self, proto, socket_path):
+    """__init__ method
+    """
+
+    self.proto = proto
+    self.socket_path = socket_path
+
+    # Lock serializing the RPC requests sent to the Flipper Zero
+    self.lock = threading.Lock()
+
+    # If the socket file is left over from a daemon that's gone, remove it,
+    # but don't take over from a daemon that's still running
+    if os.path.exists(socket_path):
+      client = connect_to_daemon(socket_path)
+      if client is not None:
+        client.close()
+        raise RuntimeError("a tflipper daemon is already running on {}".\
+				format(socket_path))
+      os.remove(socket_path)
+
+    # Create the socket file accessible to this user only from the start, so
+    # other users can't connect to it before its permissions are set
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o077)
+    try:
+      self.sock.bind(socket_path)
+    finally:
+      os.umask(umask)
+    self.sock.listen()
+
+
+
+  def serve_forever(self):
+    """Accept clients until interrupted
+    """
+
+    while True:
+      conn, _ = self.sock.accept()
+      threading.Thread(target = self.client_thread, args = (conn,),
+			daemon = True).start()
+
+
+
+  def handle_request(self, kind, payload):
+    """Execute a request on the Flipper Zero and return the reply's payload
+    """
+
+    with self.lock:
+
+      if kind == daemon_device_info:
+        return json.dumps(dict(self.proto.device_info),
+				default = str).encode("utf-8")
+
+      if kind == daemon_snapshot:
+        return self.proto.rpc_gui_snapshot_screen()
+
+      if kind == daemon_send_input:
+        self.proto.rpc_gui_send_input(payload.decode("ascii"))
+        return b""
+
+    raise ValueError("unknown tflipper daemon request {}".format(kind))
+
+
+
+  def client_thread(self, conn):
+    """Serve the requests of one client until it disconnects. Failed requests
+    are answered with the error message
+    """
+
+    with conn:
+
+      try:
+
+        while True:
+
+          request = recv_message(conn, daemon_request_fmt)
+          if request is None:
+            break
+
+          try:
+            status = daemon_ok
+            payload = self.handle_request(*request)
+          except Exception as e:
+            status = daemon_error
+            payload = str(e).encode("utf-8")
+
+          conn.sendall(struct.pack(daemon_reply_fmt, status, len(payload)) + \
+			payload)
+
+      except OSError:
+        pass
+
+
+
+  def close(self):
+    """Stop listening and remove the socket file
+    """
+
+    self.sock.close()
+
+    try:
+      os.remove(self.socket_path)
+    except OSError:
+      pass
+
+
+
+class daemon_proto:
+  """Stand-in for FlipperProto forwarding the device information, screen
+  snapshot and input event requests to a tflipper daemon. The screen stream
+  isn't available through the daemon
+  """
+
+  def __init__(self, sock):
+    """__init__ method. sock is the socket connected to the daemon
+    """
+
+    self.sock = sock
+
+    self.device_info = json.loads(self.request(daemon_device_info).\
+					decode("utf-8"))
+
+
+
+  def request(self, kind, payload = b""):
+    """Send a request to the daemon and return the reply's payload. Raise an
+    exception with the daemon's error message if the request failed
+    """
+
+    self.sock.sendall(struct.pack(daemon_request_fmt, kind, len(payload)) + \
+			payload)
+
+    reply = recv_message(self.sock, daemon_reply_fmt)
+    if reply is None:
+      raise ConnectionError("the tflipper daemon closed the connection")
+
+    status, payload = reply
+    if status != daemon_ok:
+      raise RuntimeError("tflipper daemon: {}".format(payload.decode("utf-8")))
+
+    return payload
+
+
+
+  def rpc_gui_snapshot_screen(self):
+    """Return a screen snapshot
+    """
+
+    return self.request(daemon_snapshot)
+
+
+
+  def rpc_gui_send_input(self, flipper_input):
+    """Send an input event string (e.g. "SHORT LEFT") to the Flipper Zero
+    """
+
+    self.request(daemon_send_input, flipper_input.encode("ascii"))
+
+
+
+  def rpc_gui_start_screen_stream(self):
+    """The screen stream isn't available through the daemon
+    """
+
+    raise RuntimeError("the screen stream isn't available through the "
+				"tflipper daemon")
+
+
+
+  def close(self):
+    """Disconnect from the daemon
+    """
+
+    self.sock.close()
+
+
+
+def connect_to_daemon(socket_path):
+  """Connect to the tflipper daemon listening on the Unix socket and return a
+  FlipperProto stand-in going through it, or None if no daemon is running.
+  The socket must belong to this user: the default socket may be in /tmp, where
+  another user could have created it first
+  """
+
+  if socket_path is None or not os.path.exists(socket_path):
+    return None
+
+  if os.stat(socket_path).st_uid != os.getuid():
+    print("Not connecting to the tflipper daemon: {} belongs to another "
+		"user".format(socket_path), file = sys.stderr)
+    return None
+
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+  try:
+    sock.connect(socket_path)
+    return daemon_proto(sock)
+
+  except OSError:
+    sock.close()
+    return None
+
+
+
+class frame_rate_scheduler:
+  """Pace the display captures: capture at the target rate while the display
+  changes, back off exponentially while it stays idle and snap back to the
+  target rate as soon as an input event is sent or the display changes. Frames
+  are never captured faster than the maximum rate.
+  """
+
+  def __init__(self, target_fps, max_fps):
+    """__init__ method
+    """
+
+    self.target_interval = 1 / target_fps
+    self.min_interval = 1 / max(max_fps, target_fps)
+
+    self.interval = self.target_interval
+    self.last_capture = None
+    self.next_capture = monotonic()
+    self.full_rate_until = 0
+
+
+
+  def time_to_next_capture(self):
+    """Return how long to wait before the next capture is due
+    """
+
+    return max(self.next_capture - monotonic(), 0)
+
+
+
+  def wake(self):
+    """Capture the next frame as soon as the maximum rate allows
+    """
+
+    self.interval = self.target_interval
+    self.next_capture = monotonic() if self.last_capture is None else \
+				self.last_capture + self.min_interval
+
+
+
+  def input_sent(self):
+    """An input event was sent to the Flipper Zero: capture the next frame as
+    soon as possible and keep capturing at the target rate for a while
+    """
+
+    self.wake()
+    self.full_rate_until = monotonic() + full_rate_after_input
+
+
+
+  def frame_captured(self, changed):
+    """A frame was captured: schedule the next capture depending on whether
+    the display changed
+    """
+
+    self.last_capture = monotonic()
+
+    if changed or self.last_capture < self.full_rate_until:
+      self.interval = self.target_interval
+    else:
+      self.interval = min(self.interval * 2, max_idle_capture_interval)
+
+    self.next_capture = self.last_capture + self.interval
+
+
+
+def percentiles(values, ps = (50, 90, 99, 100)):
+  """Return the given percentiles of a list of values, using the nearest-rank
+  method
+  """
+
+  values = sorted(values)
+
+  return [values[max(-(-p * len(values) // 100) - 1, 0)] for p in ps] \
+		if values else [None] * len(ps)
+
+
+
+class perf_stats:
+  """Lightweight timers around the stages of the session and counters of the
+  frames going through them, reported at the end with --stats and optionally
+  dumped as a Chrome trace JSON file with --trace. Does nothing until enabled,
+  so the timers cost next to nothing otherwise. Each stage and each counter
+  must only be updated from one thread
+  """
+
+  def __init__(self):
+    """__init__ method
+    """
+
+    self.enabled = False
+
+    # Durations of each stage, counters and, if the session is traced, the
+    # (stage, start, end, thread ID) of every timed stage and thread names
+    self.durations = {}
+    self.counters = {}
+    self.trace_events = None
+    self.thread_names = {}
+
+    self.origin = 0
+
+
+
+  def enable(self, trace = False):
+    """Start timing the stages and counting the frames, and tracing them if
+    requested
+    """
+
+    self.enabled = True
+    self.origin = perf_counter()
+
+    if trace:
+      self.trace_events = []
+
+
+
+  def clock(self):
+    """Return the start time of a stage, to pass on to timed() when it ends
+    """
+
+    return perf_counter() if self.enabled else 0
+
+
+
+  def timed(self, stage, start):
+    """A stage started at the given start time just ended
+    """
+
+    if not self.enabled:
+      return
+
+    end = perf_counter()
+    self.durations.setdefault(stage, []).append(end - start)
+
+    if self.trace_events is not None:
+      tid = threading.get_ident()
+      if tid not in self.thread_names:
+        self.thread_names[tid] = threading.current_thread().name
+      self.trace_events.append((stage, start, end, tid))
+
+
+
+  def count(self, counter, n = 1):
+    """Increment a counter
+    """
+
+    if self.enabled:
+      self.counters[counter] = self.counters.get(counter, 0) + n
+
+
+
+  def report(self):
+    """Return the counters, the latency percentiles of each stage and their
+    latency histograms
+    """
+
+    lines = ["{}: {}".format(counter, n) \
+		for counter, n in self.counters.items()]
+
+    lines.append("{:<20}{:>8}{:>10}{:>10}{:>10}{:>10}{:>10}".\
+			format("Stage", "count", "mean", "p50", "p95", "p99",
+				"max"))
+
+    for stage, durations in self.durations.items():
+      lines.append("{:<20}{:>8}".format(stage, len(durations)) + \
+		"".join(["{:>8.2f}ms".format(d * 1000) \
+			for d in [sum(durations) / len(durations)] + \
+				percentiles(durations, (50, 95, 99, 100))]))
+
+    for stage, durations in self.durations.items():
+
+      # Count the durations in each bucket, the last one being unbounded
+      buckets = [0] * (len(stats_histogram_bounds_ms) + 1)
+      for d in durations:
+        b = 0
+        while b < len(stats_histogram_bounds_ms) and \
+		d * 1000 >= stats_histogram_bounds_ms[b]:
+          b += 1
+        buckets[b] += 1
+
+      labels = ["<{}ms".format(bound) \
+			for bound in stats_histogram_bounds_ms] + \
+		[">={}ms".format(stats_histogram_bounds_ms[-1])]
+
+      # Only show the buckets from the first to the last non-empty one
+      used = [b for b, n in enumerate(buckets) if n]
+      lines.append("{} latency histogram:".format(stage))
+      for b in range(used[0], used[-1] + 1):
+        lines.append("  {:>9} |{:<{}}| {}".format(labels[b],
+				"#" * -(-buckets[b] * stats_histogram_width // \
+					max(buckets)),
+				stats_histogram_width, buckets[b]))
+
+    return "\n".join(lines)
+
+
+
+  def dump_trace(self, filename):
+    """Write the timed stages into a Chrome trace JSON file, one track per
+    thread
+    """
+
+    pid = os.getpid()
+
+    events = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+		"args": {"name": name}} \
+		for tid, name in self.thread_names.items()] + \
+		[{"name": stage, "cat": "tflipper", "ph": "X", "pid": pid,
+			"tid": tid, "ts": (start - self.origin) * 1e6,
+			"dur": (end - start) * 1e6} \
+		for stage, start, end, tid in self.trace_events or []]
+
+    with open(filename, "w") as f:
+      json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+
+# Stage timers and frame counters of the session
+stats = perf_stats()
+
+
+
+class replay_scheduler:
+  """Replay button presses at their recorded timecodes from a thread of its
+  own, timed with the monotonic clock, and keep track of how late or early each
+  button press is sent compared to its recorded timecode
+  """
+
+  def __init__(self, replay_buttons_at, send_input, on_replay = None,
+		skew_log = None, projected_duration = None):
+    """__init__ method. replay_buttons_at may be a generator: the events are
+    pulled from it one at a time, as soon as the previous one is replayed.
+    send_input is called with each Flipper Zero input event string, on_replay
+    is called after each button press event is replayed, skew_log is an
+    optional file to log the skews into and projected_duration is how long the
+    replay should take, if known
+    """
+
+    self.events = iter(replay_buttons_at)
+    self.send_input = send_input
+    self.on_replay = on_replay
+    self.skew_log = skew_log
+
+    # Replayed button presses for the main thread, followed by None once all
+    # the button presses have been replayed
+    self.replayed = queue.Queue()
+
+    # Skews of the replayed button presses
+    self.skews = []
+
+    # Projected and actual run time of the replay
+    self.projected_duration = projected_duration
+    self.duration = None
+
+    self.do_run = True
+    self.stop_event = threading.Event()
+    self.exception = None
+
+    self.thread = None
+
+
+
+  def start(self):
+    """Start replaying: timecode 0 is now
+    """
+
+    self.start_time = monotonic()
+
+    self.thread = threading.Thread(target = self.replay_thread, daemon = True)
+    self.thread.start()
+
+
+
+  def wait_until(self, t):
+    """Wait until the monotonic clock reaches t, sleeping most of the way and
+    spinning the rest. Return False if stopped in the meantime
+    """
+
+    while self.do_run:
+      wait = t - monotonic()
+      if wait <= 0:
+        return True
+      if wait > replay_spin_time:
+        self.stop_event.wait(wait - replay_spin_time)
+      else:
+        sleep(0)
+
+    return False
+
+
+
+  def wait_for_event(self, event):
+    """Wait until a button press event is due. Return False if stopped in
+    the meantime
+    """
+
+    return self.wait_until(self.start_time + event[0])
+
+
+
+  def replay_thread(self):
+    """Replay the button presses in order
+    """
+
+    try:
+
+      for event in self.events:
+
+        timecode, btns = event[:2]
+
+        if not self.wait_for_event(event):
+          return
+
+        # Send the button press events to the Flipper Zero
+        for b in btns:
+          self.send_input(("SHORT " if b.islower() else "LONG ") + \
+				button_to_flipper_key[b.upper()])
+
+        self.inputs_sent()
+        self.duration = monotonic() - self.start_time
+
+        # Record how late the button presses were sent
+        if btns:
+          actual_timecode = monotonic() - self.start_time
+          self.skews.append(actual_timecode - timecode)
+          if self.skew_log is not None:
+            skew_ms = (actual_timecode - timecode) * 1000
+            self.skew_log.write(replay_skew_log_fmt.format(timecode,
+							actual_timecode,
+							skew_ms, btns))
+
+        self.replayed.put(btns)
+        if self.on_replay is not None:
+          self.on_replay()
+
+    except Exception as e:
+      self.exception = e
+
+    self.replayed.put(None)
+    if self.on_replay is not None:
+      self.on_replay()
+
+
+
+  def inputs_sent(self):
+    """Called after the button presses of an event were sent
+    """
+
+    pass
+
+
+
+  def get_replayed(self):
+    """Return the button presses replayed since the last call, and whether all
+    the button presses have been replayed. Re-raise the replay thread's
+    exception if it failed
+    """
+
+    btns = ""
+    finished = False
+
+    while True:
+      try:
+        b = self.replayed.get_nowait()
+      except queue.Empty:
+        break
+      if b is None:
+        finished = True
+      else:
+        btns += b
+
+    if self.exception is not None:
+      raise self.exception
+
+    return btns, finished
+
+
+
+  def stop(self):
+    """Stop replaying and wait for the replay thread to end
+    """
+
+    self.do_run = False
+    self.stop_event.set()
+
+    if self.thread is not None:
+      self.thread.join()
+
+    if self.skew_log is not None:
+      self.skew_log.close()
+
+
+
+  def duration_report(self):
+    """Return the actual and projected run time of the replay for the summary
+    """
+
+    return ("" if self.duration is None else \
+		" in {:0.1f}s".format(self.duration)) + \
+		("" if self.projected_duration is None else \
+		" (projected: {:0.1f}s)".format(self.projected_duration))
+
+
+
+  def report(self):
+    """Return a summary of the skews of the replayed button presses
+    """
+
+    p50, p90, p99, pmax = percentiles([abs(s) for s in self.skews])
+
+    return "{} button press events replayed".format(len(self.skews)) + \
+		self.duration_report() + \
+		("" if not self.skews else \
+		" - absolute timing error: p50 {:0.1f}ms, p90 {:0.1f}ms, "
+		"p99 {:0.1f}ms, max {:0.1f}ms".format(p50 * 1000, p90 * 1000,
+							p99 * 1000,
+							pmax * 1000))
+
+
+
+def prune_replay_events(replay_buttons_at):
+  """Generator returning the button press events with empty button presses
+  pruned, apart from the last event that marks the end of the replay. Events
+  with button presses are returned right away
+  """
+
+  empty_event = None
+
+  for event in replay_buttons_at:
+    if event[1]:
+      empty_event = None
+      yield event
+    else:
+      empty_event = event
+
+  if empty_event is not None:
+    yield empty_event
+
+
+
+def txt_replay_events(filename):
+  """Generator returning the timecode and button presses of the invisible
+  markers of a text session record, parsed from the file chunk by chunk as
+  they're needed
+  """
+
+  with open(filename, "rb") as f:
+
+    data = b""
+
+    while True:
+
+      chunk = f.read(txt_read_chunk_size)
+      if not chunk:
+        return
+
+      data += chunk
+
+      # Keep the end of the data in case a marker straddles two chunks
+      end = 0
+      for m in re_tc_btn_marker_b.finditer(data):
+        yield float(m[1]), m[2].decode("ascii")
+        end = m.end()
+
+      data = data[max(end, len(data) - txt_marker_span):]
+
+
+
+def txt_last_timecode(filename):
+  """Return the timecode of the last invisible marker of a text session
+  record, found at the end of the file, or None if there isn't any
+  """
+
+  with open(filename, "rb") as f:
+    f.seek(max(os.fstat(f.fileno()).st_size - txt_marker_span, 0))
+    markers = re_tc_btn_marker_b.findall(f.read())
+
+  return float(markers[-1][0]) if markers else None
+
+
+
+class latency_probe:
+  """Measure the input-to-photon latency: send each input event of a script
+  once the display has settled, wait for the first captured frame that differs
+  from the display before the input event, then render it and write it out to
+  the console. The latency is split into the time to send the input event,
+  the time until the changed frame is captured and the time to render and
+  write it, and timed as stages of the session stats
+  """
+
+  def __init__(self, screen, display, btns, timeout):
+    """__init__ method. btns are the button presses to send in short form,
+    display is the display output to render the frames with
+    """
+
+    self.screen = screen
+    self.display = display
+    self.btns = btns
+    self.timeout = timeout
+
+    self.start_time = monotonic()
+
+    # Input-to-photon latencies and number of input events the display didn't
+    # react to within the timeout
+    self.latencies = []
+    self.nb_timeouts = 0
+
+
+
+  def timecode(self):
+    """Return the current timecode
+    """
+
+    return monotonic() - self.start_time
+
+
+
+  def settle(self):
+    """Wait until the display stays unchanged for a while, display it and
+    return its screen data
+    """
+
+    screen_data = self.screen.get_frame(timeout = probe_poll_interval)
+    settled_at = monotonic() + probe_settle_time
+
+    while monotonic() < settled_at:
+      new_screen_data = self.screen.get_frame(timeout = probe_poll_interval)
+      if new_screen_data != screen_data:
+        screen_data = new_screen_data
+        settled_at = monotonic() + probe_settle_time
+
+    self.display.process(captured_frame(self.timecode(), screen_data, "",
+					False))
+
+    return screen_data
+
+
+
+  def run(self):
+    """Send the input events one by one and time the display's reaction
+    """
+
+    for b in self.btns:
+
+      prev_screen_data = self.settle()
+
+      # Send the input event
+      start = stats.clock()
+      self.screen.send_input(("SHORT " if b.islower() else "LONG ") + \
+				button_to_flipper_key[b.upper()])
+      stats.timed("probe input send", start)
+
+      # Wait for the display to change
+      while True:
+        screen_data = self.screen.get_frame(timeout = probe_poll_interval)
+        if screen_data != prev_screen_data or \
+		perf_counter() - start > self.timeout:
+          break
+
+      if screen_data == prev_screen_data:
+        self.nb_timeouts += 1
+        stats.count("probe timeouts")
+        continue
+
+      stats.timed("probe screen change", start)
+
+      # Render the changed frame and write it out
+      render_start = stats.clock()
+      self.display.process(captured_frame(self.timecode(), screen_data, b,
+					False))
+      stats.timed("probe render", render_start)
+
+      stats.timed("probe total", start)
+      self.latencies.append(perf_counter() - start)
+
+
+
+  def report(self):
+    """Return a summary of the input-to-photon latencies
+    """
+
+    p50, p90, p99, pmax = percentiles(self.latencies)
+
+    return "{} input events probed, {} timed out".\
+		format(len(self.latencies) + self.nb_timeouts,
+			self.nb_timeouts) + \
+		("" if not self.latencies else \
+		" - input-to-photon latency: p50 {:0.1f}ms, p90 {:0.1f}ms, "
+		"p99 {:0.1f}ms, max {:0.1f}ms".format(p50 * 1000, p90 * 1000,
+							p99 * 1000,
+							pmax * 1000))
+
+
+
+def rescale_replay_events(replay_buttons_at, speed = 1, max_idle = None):
+  """Generator returning the button press events with the idle gaps between
+  them longer than max_idle seconds (in record time) shortened to that
+  duration, and their timecodes divided by the speed factor. The events keep
+  their order and any extra element after the timecode
+  """
+
+  prev_timecode = 0
+  timecode = 0
+
+  for event in replay_buttons_at:
+
+    gap = max(event[0] - prev_timecode, 0)
+    if max_idle is not None:
+      gap = min(gap, max_idle)
+
+    timecode += gap / speed
+    prev_timecode = max(event[0], prev_timecode)
+
+    yield (timecode,) + tuple(event[1:])
+
+
+
+def replay_sync_points(record):
+  """Return the button press events of a session record along with the screen
+  data of the frame that preceded each of them, and a last event with the last
+  timecode and button presses and the screen data of the last frame
+  """
+
+  events = []
+  screen_data = None
+  timecode = 0
+
+  for frame in record.frames():
+    if frame.flipper_inputs:
+      events.append((frame.timecode, frame.flipper_inputs, screen_data))
+    screen_data = frame.screen_data
+    timecode = frame.timecode
+
+  timecode, flipper_inputs = record.end if record.end is not None \
+				else (timecode, "")
+  events.append((timecode, flipper_inputs, screen_data))
+
+  return events
+
+
+
+class sync_replay_scheduler(replay_scheduler):
+  """Replay button presses as soon as the Flipper Zero's display matches the
+  recorded frame that preceded them, instead of at their recorded timecodes,
+  so the replay runs as fast as the Flipper Zero allows. The events are
+  (timecode, button presses, screen data to sync on) tuples. If the display
+  doesn't match within the sync timeout, the button presses are sent anyway
+  """
+
+  def __init__(self, replay_buttons_at, send_input, sync_timeout,
+		on_replay = None, skew_log = None, projected_duration = None):
+    """__init__ method. Same as replay_scheduler, with the longest time to
+    wait for the display to match before sending button presses anyway
+    """
+
+    super().__init__(replay_buttons_at, send_input, on_replay, skew_log,
+			projected_duration)
+
+    self.sync_timeout = sync_timeout
+
+    # Latest display captured since the last button presses were sent
+    self.screen_data = None
+    self.screen_data_cond = threading.Condition()
+
+    self.waiting_for_sync = False
+
+    # How long each sync took, and how many syncs timed out
+    self.sync_waits = []
+    self.nb_sync_timeouts = 0
+
+
+
+  def frame_captured(self, screen_data):
+    """Called by the main thread with each captured display
+    """
+
+    with self.screen_data_cond:
+      self.screen_data = screen_data
+      self.screen_data_cond.notify()
+
+
+
+  def wait_for_event(self, event):
+    """Wait until the display matches the frame that preceded the button
+    presses in the record, or the sync timeout expires. Return False if stopped
+    in the meantime
+    """
+
+    sync_screen_data = event[2]
+    if sync_screen_data is None:
+      return self.do_run
+
+    start = monotonic()
+    deadline = start + self.sync_timeout
+
+    with self.screen_data_cond:
+
+      self.waiting_for_sync = True
+
+      while self.do_run and self.screen_data != sync_screen_data:
+        wait = deadline - monotonic()
+        if wait <= 0:
+          self.nb_sync_timeouts += 1
+          break
+        self.screen_data_cond.wait(wait)
+
+      self.waiting_for_sync = False
+
+    if self.do_run:
+      self.sync_waits.append(monotonic() - start)
+
+    return self.do_run
+
+
+
+  def inputs_sent(self):
+    """Forget the display captured before the button presses were sent, so
+    the next sync is done on a display captured afterward
+    """
+
+    with self.screen_data_cond:
+      self.screen_data = None
+
+
+
+  def stop(self):
+    """Stop replaying, waking up the replay thread if it waits for a sync, and
+    wait for the replay thread to end
+    """
+
+    with self.screen_data_cond:
+      self.do_run = False
+      self.screen_data_cond.notify()
+
+    super().stop()
+
+
+
+  def report(self):
+    """Return a summary of the syncs of the replayed button presses
+    """
+
+    p50, p90, p99, pmax = percentiles(self.sync_waits)
+
+    return "{} button press events replayed".format(len(self.skews)) + \
+		self.duration_report() + \
+		("" if not self.sync_waits else \
+		" - {} syncs timed out - sync wait: p50 {:0.1f}ms, "
+		"p90 {:0.1f}ms, p99 {:0.1f}ms, max {:0.1f}ms".\
+			format(self.nb_sync_timeouts, p50 * 1000, p90 * 1000,
+				p99 * 1000, pmax * 1000))
+
+
+
+def semigraphics_density(args):
+  """Return the semigraphics density selected on the command line
+  """
+
+  return "2x4" if args.high_density_semigraphics else \
+		"2x3" if args.mid_density_semigraphics else "1x2"
+
+
+
+class semigraphics_renderer:
+  """Turn the Flipper Zero's 1024 bytes of screen data into lines of unicode
+  semigraphic characters using lookup tables precomputed for one density:
+
+  - "1x2": 1x2 unicode block characters, 128 x 32 characters
+  - "2x3": 2x3 unicode block characters, 64 x 22 characters
+  - "2x4": 2x4 unicode Braille characters, 64 x 16 characters
+
+  The screen data is made of 8 pages of 128 bytes, one byte per column, each
+  bit of a byte being one pixel row of the page. Each line of characters is
+  rendered from a band of pixel rows:
+
+  - With 1-column characters, the bands never straddle two pages, so the
+    page's bytes are mapped straight to the line's characters with a
+    translation table precomputed for the band's position in the page.
+
+  - With 2-column characters, the band's bits for every column are first
+    gathered into one byte per column with a few shifts and masks on the whole
+    pages taken as big integers, then pairs of those bytes are mapped straight
+    to the line's characters with a precomputed translation table.
+
+  If use_numpy is set, the bands are extracted with NumPy instead.
+  """
+
+  # Glyphs, character cell width and height for each density
+  densities = {
+    "1x2": (unicode_blocks_1x2, 1, 2),
+    "2x3": (unicode_blocks_2x3, 2, 3),
+    "2x4": (unicode_braille_2x4, 2, 4),
+  }
+
+  def __init__(self, density, use_numpy = False):
+    """__init__ method
+    """
+
+    self.glyphs, self.cell_width, self.cell_height = self.densities[density]
+    self.use_numpy = use_numpy
+
+    self.width = 128 // self.cell_width
+    self.height = -(-64 // self.cell_height)
+
+    # Repeated byte masks keeping the n lower bits of each column
+    masks = [int.from_bytes(bytes([(1 << n) - 1]) * 128, "little") \
+		for n in range(9)]
+
+    # Describe each band of pixel rows as the page it starts in, the shift of
+    # its first row in the page and the masks for the part of the band in that
+    # page and in the next page. Rows below the display -only in the last band
+    # of the 2x3 rendering- are off pixels
+    self.bands = []
+    for y in range(0, self.height * self.cell_height, self.cell_height):
+      page, shift = divmod(y, 8)
+      nbits = min(self.cell_height, 8 - shift)
+      self.bands.append((page, shift, masks[nbits], nbits,
+				masks[self.cell_height - nbits]))
+
+    # Translation tables from a page's byte to glyphs for each band position
+    # in the page -for 1-column characters- or from the band's little-endian
+    # byte pair to glyphs -for 2-column characters. Byte pairs are decoded as
+    # UTF-16 code units, which never hit the surrogate range as band bytes are
+    # at most 4 bits
+    nb_values = 1 << self.cell_height
+    if self.cell_width == 1:
+      self.tables = {shift: [self.glyphs[(v >> shift) & (nb_values - 1)] \
+				for v in range(256)] \
+			for shift in range(0, 8, self.cell_height)}
+    else:
+      self.table = [""] * (((nb_values - 1) << 8) + nb_values)
+      for a in range(nb_values):
+        for b in range(nb_values):
+          self.table[a | (b << 8)] = self.glyphs[a | (b << self.cell_height)]
+
+    # Object array of glyphs for the NumPy renderer
+    if use_numpy:
+      self.np_glyphs = numpy.array(self.glyphs, dtype = object)
+
+    # Translation table from glyphs back to bits, built the first time lines
+    # are unrendered
+    self.unrender_table = None
+
+
+
+  def band_bytes(self, page1, page2, band):
+    """Return the band's bits for every column, one byte per column, from the
+    band's page and the next page -None below the display- taken as big
+    integers
+    """
+
+    _, shift, mask1, nbits, mask2 = band
+
+    v = (page1 >> shift) & mask1
+    if mask2:
+      v |= ((mask2 if page2 is None else page2) & mask2) << nbits
+
+    return v.to_bytes(128, "little")
+
+
+
+  def render_band(self, band_data, band):
+    """Return the line of semigraphic characters for one band, from the screen
+    data of the band's page, followed by the next page's if the band straddles
+    two pages
+    """
+
+    if self.cell_width == 1:
+      return band_data.decode("latin-1").translate(self.tables[band[1]])
+
+    return self.band_bytes(int.from_bytes(band_data[:128], "little"),
+				int.from_bytes(band_data[128:], "little") \
+					if len(band_data) > 128 else None,
+				band).decode("utf-16-le").translate(self.table)
+
+
+
+  def render(self, screen_data):
+    """Return the lines of semigraphic characters for 1024 bytes of screen data
+    """
+
+    if self.use_numpy:
+      return self.render_numpy(screen_data)
+
+    if self.cell_width == 1:
+      pages = screen_data.decode("latin-1")
+      return [pages[page * 128 : page * 128 + 128].\
+			translate(self.tables[shift]) \
+		for page, shift, _, _, _ in self.bands]
+
+    pages = [int.from_bytes(screen_data[k : k + 128], "little") \
+		for k in range(0, 1024, 128)]
+
+    return [self.band_bytes(pages[band[0]],
+				pages[band[0] + 1] if band[0] < 7 else None,
+				band).decode("utf-16-le").\
+			translate(self.table) \
+		for band in self.bands]
+
+
+
+  def render_numpy(self, screen_data):
+    """Return the lines of semigraphic characters for 1024 bytes of screen
+    data, extracting the bands with NumPy
+    """
+
+    # Unpack the pages into one pixel per row and column, padded with off
+    # pixels below the display up to a whole number of bands
+    pixels = numpy.ones((self.height * self.cell_height, 128),
+			dtype = numpy.uint8)
+    pixels[:64] = numpy.unpackbits(numpy.frombuffer(screen_data,
+						dtype = numpy.uint8).\
+						reshape(8, 128),
+					axis = 0, bitorder = "little")
+
+    # Weigh each pixel by its bit in the glyph index and sum the cells up
+    weights = (1 << numpy.arange(self.cell_height * self.cell_width,
+				dtype = numpy.uint8)).\
+		reshape(self.cell_width, self.cell_height).T
+    indexes = (pixels.reshape(self.height, self.cell_height,
+				self.width, self.cell_width) * \
+		weights[None, :, None, :]).sum(axis = (1, 3))
+
+    return ["".join(l) for l in self.np_glyphs[indexes]]
+
+
+
+  def unrender(self, lines):
+    """Return the 1024 bytes of screen data rendered as lines of semigraphic
+    characters by render()
+    """
+
+    # Translation table from glyphs to the band's bits in the character's
+    # column -for 1-column characters- or columns -for 2-column characters- as
+    # latin-1 characters
+    if self.unrender_table is None:
+      nb_values = 1 << self.cell_height
+      self.unrender_table = {}
+      for v in reversed(range(len(self.glyphs))):
+        self.unrender_table[ord(self.glyphs[v])] = \
+		chr(v) if self.cell_width == 1 else \
+		chr(v & (nb_values - 1)) + chr(v >> self.cell_height)
+
+    pages = [0] * 8
+
+    # Put each band's bits back into the page it starts in and into the next
+    # page if it straddles two pages
+    for l, (page, shift, mask1, nbits, mask2) in zip(lines, self.bands):
+      v = int.from_bytes(l.translate(self.unrender_table).encode("latin-1"),
+				"little")
+      pages[page] |= (v & mask1) << shift
+      if mask2 and page < 7:
+        pages[page + 1] |= (v >> nbits) & mask2
+
+    return b"".join([page.to_bytes(128, "little") for page in pages])
+
+
+
+class row_render_cache:
+  """Memoize the lines rendered by a semigraphics renderer with LRU eviction.
+  Each line is keyed on the screen data it's rendered from -the 128-byte page
+  of its band, followed by the next page if the band straddles two pages- and
+  the position of the band in the page, so a line already seen anywhere on the
+  display only costs a dictionary lookup.
+
+  If encoding is set, the lines are cached and returned encoded.
+  """
+
+  def __init__(self, renderer, max_entries, encoding = None):
+    """__init__ method
+    """
+
+    self.renderer = renderer
+    self.max_entries = max_entries
+    self.encoding = encoding
+
+    self.lines = OrderedDict()
+
+    self.hits = 0
+    self.misses = 0
+
+
+
+  def render(self, screen_data):
+    """Return the lines of semigraphic characters for 1024 bytes of screen
+    data, rendering only the lines that aren't cached
+    """
+
+    imglines = []
+
+    for band in self.renderer.bands:
+
+      page, shift, _, _, mask2 = band
+      k = (shift, screen_data[page * 128 : page * 128 + \
+						(256 if mask2 else 128)])
+
+      l = self.lines.get(k)
+
+      if l is None:
+        self.misses += 1
+        l = self.renderer.render_band(k[1], band)
+        if self.encoding:
+          l = l.encode(self.encoding)
+        self.lines[k] = l
+        if len(self.lines) > self.max_entries:
+          self.lines.popitem(last = False)
+
+      else:
+        self.hits += 1
+        self.lines.move_to_end(k)
+
+      imglines.append(l)
+
+    return imglines
+
+
+
+def display_size(args):
+  """Return the width and height of the rendered display in characters at the
+  density selected on the command line
+  """
+
+  width = 64 if args.high_density_semigraphics or \
+		args.mid_density_semigraphics else 128
+
+  height = 16 if args.high_density_semigraphics else \
+		22 if args.mid_density_semigraphics else 32
+
+  return width, height
+
+
+
+def flipper_name_line(flipper_name, width, timecode, flipper_inputs):
+  """Return the Flipper Zero's name centered in the line above the display,
+  with the invisible timecode and button presses marker encoded into the left
+  spacer
+  """
+
+  len_flipper_name_spc1 = int((width - len(flipper_name)) / 2)
+  flipper_name_spc2 = " " * (width - len_flipper_name_spc1 - len(flipper_name))
+
+  tcbtns = invisible_tc_btn_marker_fmt.format(timecode, flipper_inputs)
+
+  return set_text_invisible + tcbtns + attributes_reset + \
+		" " * (len_flipper_name_spc1 - len(tcbtns)) + \
+		flipper_name + flipper_name_spc2
+
+
+
+# Frame captured from the Flipper Zero and passed down to the consumer stages
+captured_frame = namedtuple("captured_frame", ("timecode", "screen_data",
+						"flipper_inputs",
+						"show_keymap"))
+
+
+
+class pipeline_stage:
+  """Run a consumer of captured frames in its own thread, fed by the capture
+  stage through a bounded queue. When the queue is full, the policy decides
+  what happens to a new frame:
+
+  - "block": the capture stage waits until the consumer makes room for it, so
+             no frame is ever lost
+  - "drop":  the oldest queued frame is dropped to make room for it, so the
+             capture stage never waits for the consumer
+
+  The consumer object must have a process(frame) method called for each frame
+  and a finish(timecode, flipper_inputs) method called once at the end.
+  """
+
+  def __init__(self, consumer, queue_size, policy, name = None):
+    """__init__ method. name is the name of the consumer thread
+    """
+
+    assert policy in ("block", "drop")
+
+    self.consumer = consumer
+    self.policy = policy
+    self.q = queue.Queue(maxsize = queue_size)
+
+    self.nb_dropped_frames = 0
+
+    # Exception raised by the consumer, to re-raise in the capture stage
+    self.exception = None
+
+    self.thread = threading.Thread(target = self.consumer_thread,
+					name = name, daemon = True)
+    self.thread.start()
+
+
+
+  def consumer_thread(self):
+    """Pass the queued frames to the consumer until told to stop by None
+    """
+
+    while True:
+
+      frame = self.q.get()
+      if frame is None:
+        break
+
+      # If the consumer failed, keep draining the queue so the capture stage
+      # doesn't block
+      if self.exception is None:
+        try:
+          self.consumer.process(frame)
+        except Exception as e:
+          self.exception = e
+
+
+
+  def put(self, frame):
+    """Queue a frame for the consumer according to the policy
+    """
+
+    # If the consumer failed, re-raise its exception
+    if self.exception is not None:
+      raise self.exception
+
+    if self.policy == "block":
+      self.q.put(frame)
+      return
+
+    while True:
+
+      try:
+        self.q.put_nowait(frame)
+        return
+
+      except queue.Full:
+        try:
+          self.q.get_nowait()
+          self.nb_dropped_frames += 1
+        except queue.Empty:
+          pass
+
+
+
+  def finish(self, timecode, flipper_inputs):
+    """Let the consumer process the remaining queued frames, stop the thread
+    and finish the consumer
+    """
+
+    self.q.put(None)
+    self.thread.join()
+
+    self.consumer.finish(timecode, flipper_inputs)
+
+    if self.exception is not None:
+      raise self.exception
+
+
+
+class ansi_writer:
+  """Assemble the console output as bytes in one reusable buffer, emitting SGR
+  attributes only when they change, and write the buffer out to the console
+  with a single write
+  """
+
+  def __init__(self):
+    """__init__ method
+    """
+
+    self.buf = bytearray()
+    self.len = 0
+
+    # Current SGR attributes: empty after an attributes reset
+    self.sgr = b""
+
+    # Make sure anything already printed goes out first
+    sys.stdout.flush()
+
+    # On Windows, write through sys.stdout so colorama gets to translate the
+    # ANSI escape codes, otherwise write straight to the file descriptor
+    self.fd = None if sys.platform[0:3] == "win" else sys.stdout.fileno()
+
+
+
+  def write(self, data):
+    """Append bytes to the buffer
+    """
+
+    n = self.len + len(data)
+    self.buf[self.len : n] = data
+    self.len = n
+
+
+
+  def set_sgr(self, sgr):
+    """Switch to the SGR attributes set by the sgr escape codes -or to the
+    default attributes if empty- if they're not the current attributes
+    """
+
+    if sgr != self.sgr:
+      self.write(attributes_reset_b + sgr if self.sgr else sgr)
+      self.sgr = sgr
+
+
+
+  def flush(self):
+    """Write the buffer out and empty it
+    """
+
+    with memoryview(self.buf) as m:
+
+      if self.fd is None:
+        sys.stdout.write(m[:self.len].tobytes().decode("utf-8"))
+        sys.stdout.flush()
+
+      else:
+        i = 0
+        while i < self.len:
+          i += os.write(self.fd, m[i : self.len])
+
+    self.len = 0
+
+
+
+class display_output:
+  """Pipeline consumer printing the Flipper Zero's display in the console, or
+  only the button presses if the normal display output is suppressed
+  """
+
+  def __init__(self, args, flipper_name, bottom_line, keymap_help):
+    """__init__ method
+    """
+
+    self.args = args
+    self.flipper_name = flipper_name
+
+    self.width, self.height = display_size(args)
+
+    self.renderer = row_render_cache(semigraphics_renderer(
+						semigraphics_density(args),
+						args.numpy),
+					row_render_cache_size,
+					encoding = "utf-8")
+
+    # SGR attributes of the semigraphic characters
+    self.sgr_display = (set_bg_color.format(ansi_8bit_black) + \
+			set_fg_color.format(ansi_8bit_orange) + \
+			(attribute_bold if args.bold else "")).encode("ascii")
+
+    self.keymap_help = [l.encode("utf-8") for l in keymap_help]
+    self.keymap_help_line_len = len(keymap_help[0])
+    self.keymap_help_overlay_at_col = int((self.width - \
+						self.keymap_help_line_len) / 2)
+    self.keymap_help_overlay_at_line = int((self.height - \
+						len(keymap_help)) / 2)
+
+    # Left spacer length and right spacer for the Flipper Zero's name
+    self.len_flipper_name_spc1 = int((self.width - len(flipper_name)) / 2)
+    self.flipper_name_spc2 = " " * (self.width - self.len_flipper_name_spc1 - \
+					len(flipper_name))
+
+    # Bottom help line with its left and right spacers
+    bottom_line_spc1 = " " * int((self.width - len(bottom_line)) / 2)
+    bottom_line_spc2 = " " * (self.width - len(bottom_line_spc1) - \
+				len(bottom_line))
+    self.bottom_line = ((b"", (bottom_line_spc1 + bottom_line + \
+				bottom_line_spc2).encode("utf-8")),)
+
+    self.writer = None if args.no_display else ansi_writer()
+
+    self.nb_lines_back_up = 0
+    self.cursor_visible = True
+
+    # Lines of the last display drawn
+    self.prev_lines = None
+
+
+
+  def write_line(self, line):
+    """Write a display line made of (SGR attributes, text) segments
+    """
+
+    for sgr, text in line:
+      self.writer.set_sgr(sgr)
+      self.writer.write(text)
+
+
+
+  def process(self, frame):
+    """Print a frame
+    """
+
+    # Is the normal display output suppressed?
+    if self.args.no_display:
+
+      # Print the timecode and keypresses
+      for b in frame.flipper_inputs:
+        print("[{:0.3f}s] {}{}".
+		format(frame.timecode,
+			{"L": "\u2190", "D": "\u2193",
+				"U": "\u2191", "R": "\u2192",
+				 "O": "o", "B": "\u21B0"}[b.upper()],
+			"" if b.islower() else " (long press)"))
+      return
+
+    # Hide the cursor if needed
+    if self.cursor_visible:
+      self.writer.write(set_cursor_invisible_b)
+      self.cursor_visible = False
+
+    render_start = stats.clock()
+
+    # Turn the screen data into lines of unicode elements, encoded
+    imglines = self.renderer.render(frame.screen_data)
+
+    # Generate the display lines as (SGR attributes, text) segments: first the
+    # Flipper Zero's name with the invisible timecode and button presses marker
+    # encoded into the left spacer
+    tcbtns = invisible_tc_btn_marker_fmt.format(frame.timecode,
+						frame.flipper_inputs)
+    lines = [((set_text_invisible_b, tcbtns.encode("ascii")),
+		(b"", (" " * (self.len_flipper_name_spc1 - len(tcbtns)) + \
+			self.flipper_name + self.flipper_name_spc2).\
+			encode("utf-8")))]
+
+    # Then the semigraphic characters
+    lines.extend([((self.sgr_display, l),) for l in imglines])
+
+    # If the keymap help should be displayed, overlay it over the lines
+    if frame.show_keymap:
+      for i, l in enumerate(self.keymap_help):
+        imgline = imglines[self.keymap_help_overlay_at_line + i].\
+			decode("utf-8")
+        lines[self.keymap_help_overlay_at_line + i + 1] = \
+		((self.sgr_display,
+			imgline[:self.keymap_help_overlay_at_col].\
+				encode("utf-8")),
+		(b"", l),
+		(self.sgr_display,
+			imgline[self.keymap_help_overlay_at_col + \
+				self.keymap_help_line_len:].encode("utf-8")))
+
+    # Then the bottom help line
+    lines.append(self.bottom_line)
+
+    # If we only redraw the lines that changed and the display was drawn
+    # before, move the cursor down to each changed line, rewrite it and move
+    # the cursor back up to the first line
+    if self.args.incremental_redraw and self.prev_lines is not None:
+
+      cursor_at_line = 0
+
+      for i, (l, prev_l) in enumerate(zip(lines, self.prev_lines)):
+        if l != prev_l:
+          if i > cursor_at_line:
+            self.writer.write(x_lines_down.format(i - cursor_at_line).\
+					encode("ascii"))
+          self.write_line(l)
+          self.writer.write(CR_b)
+          cursor_at_line = i
+
+      if cursor_at_line:
+        self.writer.write(x_lines_up.format(cursor_at_line).encode("ascii"))
+
+    # Otherwise output the entire display. The first time around, reset the
+    # attributes before each line feed, as the console may scroll and fill the
+    # new line with the current background color
+    else:
+
+      for i, l in enumerate(lines):
+        if i:
+          if self.prev_lines is None:
+            self.writer.set_sgr(b"")
+          self.writer.write(CR_b + LF_b)
+        self.write_line(l)
+
+      self.writer.write((x_lines_up.format(1) + CR + LF + \
+				x_lines_up.format(self.height + 1)).\
+				encode("ascii"))
+
+    self.prev_lines = lines
+
+    stats.timed("render", render_start)
+    stats.count("frames rendered")
+
+    # Print the ANSI text in one go so the console is updated immediately
+    write_start = stats.clock()
+    self.writer.flush()
+    stats.timed("console write", write_start)
+
+    self.nb_lines_back_up = self.height + 1
+
+
+
+  def finish(self, timecode, flipper_inputs):
+    """Output the last invisible timecode and button presses marker, skip past
+    the rendering and show the cursor again
+    """
+
+    if self.args.no_display:
+      sys.stdout.flush()
+      return
+
+    self.writer.write(CR_b)
+    self.writer.set_sgr(set_text_invisible_b)
+    self.writer.write(invisible_tc_btn_marker_fmt.
+				format(timecode, flipper_inputs).\
+				encode("ascii"))
+    self.writer.set_sgr(b"")
+    self.writer.write(CR_b + LF_b * (self.nb_lines_back_up + 1))
+
+    # Show the cursor again if needed
+    if not self.cursor_visible:
+      self.writer.write(set_cursor_visible_b)
+
+    self.writer.flush()
+
+    # Count the lines rendered from the cache
+    stats.count("render cache hits (display)", self.renderer.hits)
+    stats.count("render cache misses (display)", self.renderer.misses)
+
+
+
+class txt_recorder:
+  """Pipeline consumer recording the session as ANSI text in a text file, or
+  writing it into an already open text stream
+  """
+
+  def __init__(self, args, flipper_name, stream = None):
+    """__init__ method
+    """
+
+    self.args = args
+    self.flipper_name = flipper_name
+
+    self.width, self.height = display_size(args)
+
+    self.extra_attributes = attribute_bold if args.bold else ""
+
+    self.renderer = row_render_cache(semigraphics_renderer(
+						semigraphics_density(args),
+						args.numpy),
+					row_render_cache_size)
+
+    self.rt = open(args.txt, "w", encoding = "utf-8") \
+		if stream is None else stream
+    self.close_rt = stream is None
+
+    self.nb_lines_back_up = 0
+
+
+
+  def process(self, frame):
+    """Record a frame
+    """
+
+    start = stats.clock()
+
+    imglines = self.renderer.render(frame.screen_data)
+
+    # Generate the ANSI text for the record without help overlay or bottom
+    # help line
+    at = flipper_name_line(self.flipper_name, self.width, frame.timecode,
+				frame.flipper_inputs) + CR + LF + \
+		"".join([set_bg_color.format(ansi_8bit_black) + \
+				set_fg_color.format(ansi_8bit_orange) + \
+				self.extra_attributes + l + attributes_reset + \
+				CR + LF \
+				for l in imglines]) + \
+		x_lines_up.format(self.height + 1)
+
+    # Save the ANSI text into the file
+    self.rt.write(at)
+    self.nb_lines_back_up = self.height + 1
+
+    stats.timed("txt record", start)
+    stats.count("frames recorded (txt)")
+
+
+
+  def finish(self, timecode, flipper_inputs):
+    """Record the last invisible timecode and button presses marker, skip past
+    the rendering and close the file
+    """
+
+    self.rt.write(CR + set_text_invisible + \
+		invisible_tc_btn_marker_fmt.format(timecode, flipper_inputs) + \
+		attributes_reset + CR + LF * (self.nb_lines_back_up + 1))
+
+    if self.close_rt:
+      self.rt.close()
+    else:
+      self.rt.flush()
+
+    # Count the lines rendered from the cache
+    stats.count("render cache hits (txt)", self.renderer.hits)
+    stats.count("render cache misses (txt)", self.renderer.misses)
+
+
+
+def screen_data_to_image(screen_data):
+  """Convert 1024 bytes of Flipper Zero screen data into a 512x256 image with
+  the 4-color GIF palette, scaled up x4
+  """
+
+  image_data = b"".join([screen_data[k : k + 128].translate(gif_bit_tables[j]) \
+				for k in range(0, 1024, 128) \
+				for j in range(8)])
+  image = Image.frombytes(mode = "P", size = (128, 64), data = image_data).\
+				resize((512, 256), resample = Image.BOX)
+  image.putpalette(gif_palette)
+
+  return image
+
+
+
+def image_to_screen_data(image):
+  """Convert a 512x256 image with the 4-color GIF palette back into 1024 bytes
+  of Flipper Zero screen data
+  """
+
+  pixels = image.resize((128, 64), resample = Image.NEAREST).tobytes()
+
+  return b"".join([sum([int.from_bytes(pixels[(y + j) * 128 : \
+						(y + j + 1) * 128].\
+						translate(gif_index_to_pixel),
+					"little") << j \
+				for j in range(8)]).to_bytes(128, "little") \
+			for y in range(0, 64, 8)])
+
+
+
+class gif_recorder:
+  """Pipeline consumer recording the session as an animated GIF. The frames
+  are appended to the file as soon as their durations are known
+  """
+
+  def __init__(self, args, pool = None):
+    """__init__ method. The GIF frames are encoded in the process pool if one
+    is passed
+    """
+
+    self.args = args
+
+    self.gif = gif_stream_writer(args.gif, (512, 256),
+				gif_delta_palette if args.gif_delta \
+					else gif_palette,
+				pool = pool)
+
+    # Last image written to the GIF file, that the next image is a delta of
+    # when recording deltas
+    self.last_written_image = None
+
+    # Last GIF frame, whose duration isn't known yet, and its timecode
+    self.pending_frame = None
+    self.pending_frame_timecode = None
+
+    self.nb_written_frames = 0
+
+    self.gif_frame_no = 0
+
+
+
+  def write_image(self, image, duration_ms):
+    """Write an image into the GIF file. When recording deltas, make the
+    pixels that didn't change since the last image transparent so the last
+    image shows through them, and only write the lines down to the last line
+    that changed.
+
+    The first line holds the invisibly encoded string, which changes with
+    every frame, and each GIF frame is a single image block so that it plays
+    back with the right duration: the block written always starts at the first
+    line and spans the full width of the image, rather than just the
+    bounding box of the changed pixels
+    """
+
+    if not self.args.gif_delta or self.last_written_image is None:
+      self.gif.write_frame(image, duration_ms)
+
+    else:
+
+      # Find the pixels that changed since the last image
+      diff = ImageChops.difference(
+		Image.frombytes("L", image.size, image.tobytes()),
+		Image.frombytes("L", image.size,
+				self.last_written_image.tobytes()))
+      bbox = diff.getbbox()
+
+      # Only write the lines from the first line down to the last line with
+      # changed pixels
+      crop_box = (0, 0, image.size[0], max(bbox[3] if bbox else 0, 1))
+
+      # Replace the pixels that didn't change with transparent pixels, apart
+      # from those in the first line
+      delta_image = Image.new("P", image.size, gif_transparent_color)
+      delta_image.putpalette(gif_delta_palette)
+      delta_image.paste(image, mask = diff.point(lambda v: 255 if v else 0))
+      delta_image.paste(image.crop((0, 0, image.size[0], 1)))
+
+      # Write the delta image over the last image
+      self.gif.write_frame(delta_image.crop(crop_box), duration_ms,
+				transparency = gif_transparent_color,
+				disposal = 1)
+
+    self.last_written_image = image
+
+
+
+  def write_frame(self, image, duration_ms):
+    """Write a GIF frame out. Before the first frame, write a copy of it with
+    a very small duration, because some video players don't play edge frames
+    with the correct duration -e.g. mplayer
+    """
+
+    if not self.nb_written_frames:
+
+      # Duplicate of the first frame with frame number -1 invisible encoded in
+      # it
+      edge_image = copy(image)
+      steg_encode(edge_image, "[-1]")
+      self.write_image(edge_image, min_gif_frame_duration_ms)
+
+      duration_ms = max(duration_ms - min_gif_frame_duration_ms,
+				min_gif_frame_duration_ms)
+
+    self.write_image(image, duration_ms)
+    self.nb_written_frames += 1
+
+
+
+  def write_pending_frame(self, timecode, frame_no_fmt, last = False):
+    """Write the pending GIF frame out now that its duration is known,
+    repeating it as many times as needed if it's longer than the longest GIF
+    frame duration
+    """
+
+    # The difference between this timecode and the pending GIF frame's
+    # timecode is the pending GIF frame's duration
+    frame_duration_ms = (timecode - self.pending_frame_timecode) * 1000
+
+    # Repeat the pending GIF frame as many times as needed, encode only the
+    # frame number invisibly into the image then increment the frame number
+    while frame_duration_ms > max_gif_frame_duration_ms + \
+					min_gif_frame_duration_ms:
+      self.write_frame(self.pending_frame, max_gif_frame_duration_ms)
+      image = copy(self.pending_frame)
+      steg_encode(image, frame_no_fmt.format(self.gif_frame_no))
+      self.gif_frame_no += 1
+      self.pending_frame = image
+      frame_duration_ms -= max_gif_frame_duration_ms
+
+    frame_duration_ms = max(frame_duration_ms, min_gif_frame_duration_ms)
+
+    # Shorten the final GIF frame to make room for the final edge frame
+    if last:
+      frame_duration_ms = max(frame_duration_ms - min_gif_frame_duration_ms,
+				min_gif_frame_duration_ms)
+
+    self.write_frame(self.pending_frame, frame_duration_ms)
+
+
+
+  def process(self, frame):
+    """Record a frame
+    """
+
+    # Is there a pending GIF frame?
+    if self.pending_frame is not None:
+      start = stats.clock()
+      self.write_pending_frame(frame.timecode, "{}")
+      stats.timed("gif write", start)
+
+    start = stats.clock()
+
+    # Convert the Flipper's screen data into an image and scale it up x4
+    image = screen_data_to_image(frame.screen_data)
+
+    # Encode the frame number, timecode and flipper inputs invisibly into the
+    # image then increment the frame number
+    steg_encode(image, "[{}] ".format(self.gif_frame_no) + \
+			set_text_invisible + \
+			invisible_tc_btn_marker_fmt.
+				format(frame.timecode, frame.flipper_inputs) + \
+			attributes_reset)
+    self.gif_frame_no += 1
+
+    stats.timed("gif upscale+steg", start)
+    stats.count("frames recorded (gif)")
+
+    # The image is the new pending GIF frame
+    self.pending_frame = image
+    self.pending_frame_timecode = frame.timecode
+
+
+
+  def finish(self, timecode, flipper_inputs):
+    """Write the final GIF frame with the last timecode as its duration, add
+    the final edge frame and close the animated GIF file
+    """
+
+    start = stats.clock()
+
+    # If we have a pending frame, write it and add a copy of it with the last
+    # frame number, last timecode and last flipper inputs invisibly encoded in
+    # it and a very small duration, because some video players don't play edge
+    # frames with the correct duration -e.g. mplayer
+    if self.pending_frame is not None:
+
+      self.write_pending_frame(timecode, "[{}]", last = True)
+
+      image = copy(self.pending_frame)
+      steg_encode(image, "[{}] ".format(self.gif_frame_no) + \
+			set_text_invisible + \
+			invisible_tc_btn_marker_fmt.
+				format(timecode, flipper_inputs)  + \
+			attributes_reset)
+      self.write_image(image, min_gif_frame_duration_ms)
+
+    self.gif.close()
+
+    stats.timed("gif save", start)
+
+
+
+class tfr_recorder:
+  """Pipeline consumer recording the session in the compact binary tfr format:
+
+  - Header: magic, length of the Flipper's name and the Flipper's name
+  - One record per frame: record kind, timecode, length of the button presses,
+    length of the payload, button presses and payload. The payload of a
+    keyframe is the raw screen data, the payload of a delta frame is the XOR
+    of the screen data with the previous frame's. Both are deflated
+  - End record with the last timecode and the last button presses
+  - Frame index: offset, timecode and kind of each frame record
+  - Footer: offset of the frame index, number of frames and index magic
+  """
+
+  def __init__(self, args, flipper_name):
+    """__init__ method
+    """
+
+    self.args = args
+
+    self.f = open(args.bin, "wb")
+
+    name = flipper_name.encode("utf-8")
+    self.f.write(struct.pack(tfr_header_fmt, tfr_magic, len(name)) + name)
+
+    self.prev_screen_data = None
+    self.index = []
+
+
+
+  def write_record(self, kind, timecode, flipper_inputs, payload):
+    """Write a record and return its offset in the file
+    """
+
+    offset = self.f.tell()
+    flipper_inputs = flipper_inputs.encode("ascii")
+
+    self.f.write(struct.pack(tfr_record_fmt, kind, timecode,
+				len(flipper_inputs), len(payload)) + \
+		flipper_inputs + payload)
+
+    return offset
+
+
+
+  def process(self, frame):
+    """Record a frame
+    """
+
+    start = stats.clock()
+
+    # Write a keyframe every now and then so the frames can be seeked fast,
+    # otherwise write the difference with the previous frame
+    if len(self.index) % tfr_keyframe_interval == 0:
+      kind = tfr_keyframe
+      data = frame.screen_data
+    else:
+      kind = tfr_delta_frame
+      data = (int.from_bytes(frame.screen_data, "big") ^ \
+		int.from_bytes(self.prev_screen_data, "big")).\
+		to_bytes(len(frame.screen_data), "big")
+
+    deflater = zlib.compressobj(9, zlib.DEFLATED, -15)
+    payload = deflater.compress(data) + deflater.flush()
+
+    self.index.append((self.write_record(kind, frame.timecode,
+						frame.flipper_inputs, payload),
+			frame.timecode, kind))
+
+    self.prev_screen_data = frame.screen_data
+
+    # Flush the record so it makes it to the file even if we crash later
+    self.f.flush()
+
+    stats.timed("tfr record", start)
+    stats.count("frames recorded (tfr)")
+
+
+
+  def finish(self, timecode, flipper_inputs):
+    """Write the end record, the frame index and the footer, and close the
+    file
+    """
+
+    self.write_record(tfr_end_record, timecode, flipper_inputs, b"")
+
+    index_offset = self.f.tell()
+    self.f.write(b"".join([struct.pack(tfr_index_entry_fmt, *entry) \
+				for entry in self.index]) + \
+		struct.pack(tfr_footer_fmt, index_offset, len(self.index),
+				tfr_index_magic))
+    self.f.close()
+
+
+
+class tfr_reader:
+  """Read a session recorded in the binary tfr format by seeking directly into
+  the memory-mapped file. If the frame index is missing -e.g. the recording
+  was interrupted- the records are scanned to rebuild it
+  """
+
+  def __init__(self, filename):
+    """__init__ method
+    """
+
+    self.f = open(filename, "rb")
+
+    # A recording killed right after it started may leave a file too short
+    # to hold the header, that can't even be memory-mapped if it's empty
+    if os.fstat(self.f.fileno()).st_size < struct.calcsize(tfr_header_fmt):
+      self.f.close()
+      raise ValueError("{} is not a tfr file".format(filename))
+
+    self.data = mmap.mmap(self.f.fileno(), 0, access = mmap.ACCESS_READ)
+
+    magic, name_len = struct.unpack_from(tfr_header_fmt, self.data, 0)
+    if magic != tfr_magic:
+      raise ValueError("{} is not a tfr file".format(filename))
+
+    i = struct.calcsize(tfr_header_fmt)
+    self.flipper_name = self.data[i : i + name_len].decode("utf-8")
+    self.records_offset = i + name_len
+
+    # Last timecode and button presses, if the end record was written
+    self.end = None
+
+    # Read the frame index from the footer
+    footer_size = struct.calcsize(tfr_footer_fmt)
+    if len(self.data) >= self.records_offset + footer_size:
+      index_offset, nb_frames, index_magic = struct.unpack_from(
+				tfr_footer_fmt, self.data,
+				len(self.data) - footer_size)
+    else:
+      index_magic = None
+
+    if index_magic == tfr_index_magic:
+      self.index = list(struct.iter_unpack(tfr_index_entry_fmt,
+				self.data[index_offset : index_offset + \
+					nb_frames * \
+					struct.calcsize(tfr_index_entry_fmt)]))
+      end_record_offset = self.next_record_offset(self.index[-1][0]) \
+				if self.index else self.records_offset
+      kind, timecode, flipper_inputs, _ = self.record(end_record_offset)
+      self.end = (timecode, flipper_inputs)
+
+    # No footer: rebuild the frame index from the complete records
+    else:
+      self.index = []
+      i = self.records_offset
+      record_header_size = struct.calcsize(tfr_record_fmt)
+      while i + record_header_size <= len(self.data):
+        kind, timecode, _, _ = struct.unpack_from(tfr_record_fmt, self.data, i)
+        next_i = self.next_record_offset(i)
+        if next_i > len(self.data):
+          break
+        if kind == tfr_end_record:
+          self.end = self.record(i)[1:3]
+          break
+        self.index.append((i, timecode, kind))
+        i = next_i
+
+    # Last decoded frame, so frames read in sequence are decoded fast
+    self.last_frame_no = None
+    self.last_screen_data = None
+
+
+
+  def next_record_offset(self, i):
+    """Return the offset of the record following the record at offset i
+    """
+
+    _, _, flipper_inputs_len, payload_len = struct.unpack_from(tfr_record_fmt,
+								self.data, i)
+    return i + struct.calcsize(tfr_record_fmt) + flipper_inputs_len + \
+		payload_len
+
+
+
+  def record(self, i):
+    """Return the kind, timecode, button presses and payload of the record at
+    offset i
+    """
+
+    kind, timecode, flipper_inputs_len, payload_len = struct.unpack_from(
+						tfr_record_fmt, self.data, i)
+    i += struct.calcsize(tfr_record_fmt)
+
+    return kind, timecode, \
+		self.data[i : i + flipper_inputs_len].decode("ascii"), \
+		self.data[i + flipper_inputs_len : \
+				i + flipper_inputs_len + payload_len]
+
+
+
+  def __len__(self):
+    """Number of frames
+    """
+
+    return len(self.index)
+
+
+
+  def frame(self, n):
+    """Decode frame number n and return it as a captured frame
+    """
+
+    # Start from the last decoded frame if it precedes this frame with no
+    # keyframe in between, otherwise from the closest keyframe before it
+    if self.last_frame_no is not None and self.last_frame_no < n and \
+		not any([self.index[i][2] == tfr_keyframe \
+			for i in range(self.last_frame_no + 1, n + 1)]):
+      start = self.last_frame_no + 1
+      screen_data = self.last_screen_data
+    else:
+      start = n
+      while self.index[start][2] != tfr_keyframe:
+        start -= 1
+      screen_data = None
+
+    for i in range(start, n + 1):
+      kind, timecode, flipper_inputs, payload = self.record(self.index[i][0])
+      data = zlib.decompress(payload, -15)
+      if kind == tfr_keyframe:
+        screen_data = data
+      else:
+        screen_data = (int.from_bytes(data, "big") ^ \
+			int.from_bytes(screen_data, "big")).\
+			to_bytes(len(data), "big")
+
+    self.last_frame_no = n
+    self.last_screen_data = screen_data
+
+    return captured_frame(timecode, screen_data, flipper_inputs, False)
+
+
+
+  def frames(self, start = 0):
+    """Generator returning the frames in sequence from frame number start
+    """
+
+    for n in range(start, len(self.index)):
+      yield self.frame(n)
+
+
+
+  def markers(self):
+    """Return the timecodes and button presses of all the frames, followed by
+    the last timecode and button presses if the end record was written
+    """
+
+    return [self.record(i)[1:3] for i, _, _ in self.index] + \
+		([self.end] if self.end is not None else [])
+
+
+
+  def close(self):
+    """Close the file
+    """
+
+    self.data.close()
+    self.f.close()
+
+
+
+  def __enter__(self):
+    """__enter__ method
+    """
+
+    return self
+
+
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    """__exit__ method
+    """
+
+    self.close()
+
+
+
+def parse_txt_frame(block):
+  """Parse the ANSI text of one frame of a text session record and return it
+  as a captured frame. The last block of the record only holds the last
+  invisible timecode and button presses marker, and is returned as a captured
+  frame without screen data. Runs in the process pool if there is one
+  """
+
+  text = block.decode("utf-8")
+
+  m = re_tc_btn_marker.search(text)
+  if not m:
+    raise ValueError("missing timecode marker in text session record")
+
+  # The last block starts with a CR instead of the Flipper's name line
+  if text.startswith(CR):
+    return captured_frame(float(m[1]), None, m[2], False)
+
+  # Skip the Flipper's name line and strip the attributes from the lines of
+  # semigraphic characters
+  lines = [re_sgr.sub("", l) \
+		for l in text.split(CR + LF)[1:] if l]
+
+  density = densities_by_size[(len(lines[0]), len(lines))]
+  if density not in txt_unrenderers:
+    txt_unrenderers[density] = semigraphics_renderer(density)
+
+  return captured_frame(float(m[1]),
+				txt_unrenderers[density].unrender(lines),
+				m[2], False)
+
+
+
+class txt_record_reader:
+  """Read the frames of a text session record, recovering the screen data from
+  the semigraphic characters. The frames are parsed in the process pool if
+  one is passed
+  """
+
+  def __init__(self, filename, pool = None):
+    """__init__ method
+    """
+
+    self.f = open(filename, "rb")
+    self.data = mmap.mmap(self.f.fileno(), 0, access = mmap.ACCESS_READ)
+
+    self.pool = pool
+
+    # Get the Flipper's name from the first line
+    first_line = self.data[: self.data.find(LF_b)].\
+			decode("utf-8")
+    self.flipper_name = re_sgr.sub("",
+				re_tc_btn_marker.sub("", first_line)).\
+				strip() or default_flipper_name
+
+    self.end = None
+
+
+
+  def blocks(self):
+    """Generator returning the ANSI text of each frame, followed by the text
+    after the last frame
+    """
+
+    start = 0
+    for m in re_x_lines_up.finditer(self.data):
+      yield self.data[start : m.start()]
+      start = m.end()
+
+    yield self.data[start:]
+
+
+
+  def frames(self):
+    """Generator returning the frames, then setting the last timecode and
+    button presses
+    """
+
+    if self.pool is None:
+      frames = map(parse_txt_frame, self.blocks())
+    else:
+      frames = self.pool.imap(parse_txt_frame, self.blocks(),
+				txt_frames_chunk_size)
+
+    for frame in frames:
+      if frame.screen_data is None:
+        self.end = (frame.timecode, frame.flipper_inputs)
+      else:
+        yield frame
+
+
+
+  def close(self):
+    """Close the file
+    """
+
+    self.data.close()
+    self.f.close()
+
+
+
+def palette_image(palette):
+  """Return an image with the palette of a GIF file, to map RGB GIF frames
+  back to color indices
+  """
+
+  image = Image.new("P", (1, 1))
+  image.putpalette([c for rgb, _ in sorted(palette.items(),
+						key = lambda e: e[1]) \
+			for c in rgb])
+
+  return image
+
+
+
+class gif_record_reader:
+  """Read the frames of an animated GIF session record, recovering the screen
+  data from the images and the timecodes and button presses from their
+  invisible markers
+  """
+
+  def __init__(self, filename):
+    """__init__ method
+    """
+
+    self.filename = filename
+
+    # GIF session records don't hold the Flipper's name
+    self.flipper_name = default_flipper_name
+
+    self.end = None
+
+
+
+  def close(self):
+    """Nothing to close: the GIF file is only open while reading the frames
+    """
+
+    pass
+
+
+
+  def frames(self):
+    """Generator returning the frames, then setting the last timecode and
+    button presses
+    """
+
+    # Keep the GIF frames in palette mode if the version of Pillow allows it,
+    # so they don't need to be converted to RGB. The loading strategy is
+    # global to Pillow, so restore it once the frames are read
+    prev_loading_strategy = getattr(GifImagePlugin, "LOADING_STRATEGY", None)
+    try:
+      GifImagePlugin.LOADING_STRATEGY = \
+		GifImagePlugin.LoadingStrategy.RGB_AFTER_DIFFERENT_PALETTE_ONLY
+    except AttributeError:
+      pass
+
+    try:
+
+      with Image.open(self.filename) as gif:
+
+        palette = gif.palette.colors
+
+        # Only keep the frames with a timecode marker: the first edge frame and
+        # the frames repeated because they last too long for one GIF frame only
+        # have a frame number. The last frame with a marker is the final edge
+        # frame, holding the last timecode and button presses
+        prev_frame = None
+
+        for n in range(gif.n_frames):
+
+          gif.seek(n)
+          image = gif if gif.mode == "P" else gif.convert("RGB")
+
+          m = re_tc_btn_marker.search(steg_decode(image, palette))
+          if not m:
+            continue
+
+          if prev_frame is not None:
+            yield prev_frame
+
+          if image.mode != "P":
+            image = image.quantize(palette = palette_image(palette))
+
+          prev_frame = captured_frame(float(m[1]),
+				image_to_screen_data(image), m[2],
+				False)
+
+    finally:
+      if prev_loading_strategy is not None:
+        GifImagePlugin.LOADING_STRATEGY = prev_loading_strategy
+
+    if prev_frame is not None:
+      self.end = (prev_frame.timecode, prev_frame.flipper_inputs)
+
+
+
+def open_record(filename, pool = None):
+  """Open a session record in any format, detected from the start of the file
+  """
+
+  with open(filename, "rb") as f:
+    magic = f.read(len(tfr_magic))
+
+  # A tfr file cut short before the end of its magic -e.g. left empty by a
+  # recording killed right after it started- is reported as an invalid tfr
+  # file too
+  if magic == tfr_magic[:len(magic)] and \
+		(magic or filename.lower().endswith(".tfr")):
+    return tfr_reader(filename)
+
+  if magic[:3] == b"GIF":
+    return gif_record_reader(filename)
+
+  return txt_record_reader(filename, pool)
+
+
+
+## Main routine
+#
+
+def main(argv = None, proto = None):
+  """Run a session with the command line arguments in argv -or sys.argv if
+  None- with the Flipper Zero, or with the FlipperProto-like object proto if
+  given instead of connecting to the Flipper Zero
+  """
+
+  # If we run on Windows, initialize colorama, so the Windows console
+  # understands ANSI escape codes
+  if sys.platform[0:3] == "win":
+    colorama.init()
+
+  # Parse the command line arguments
+  argparser = argparse.ArgumentParser()
+
+  argparser.add_argument(
+	  "-d", "--device",
+	  help = "Flipper Zero serial device to use. Default: autodetect",
+	  type = str
+	)
+
+  argparser.add_argument(
+	  "--daemon",
+	  help = "Connect to the Flipper Zero and keep the connection open to "
+			"serve other tflipper instances, which connect to the "
+			"daemon instead of the Flipper Zero when it's running",
+	  action = "store_true"
+	)
+
+  argparser.add_argument(
+	  "--daemon-socket",
+	  help = "Unix socket the tflipper daemon listens on. Default: {}".\
+			format(default_daemon_socket()),
+	  type = str,
+	  default = default_daemon_socket()
+	)
+
+  argparser.add_argument(
+	  "--no-daemon",
+	  help = "Connect to the Flipper Zero directly even if a tflipper "
+			"daemon is running. Implied by --device",
+	  action = "store_true"
+	)
+
+  argparser.add_argument(
+	  "-M", "--mid-density-semigraphics",
+	  help = "Use 2x3 unicode block characters for rendering (smaller "
+			"console needed but incorrect aspect ratio). "
+			"Default: 1x2 unicode block characters",
+	  action = "store_true"
+	)
+
+  argparser.add_argument(
+	  "-H", "--high-density-semigraphics",
+	  help = "Use 2x4 unicode Braille characters for rendering (smaller "
+			"console needed but uses dots instead of full pixels). "
+			"Default: 1x2 unicode block characters",
+	  action = "store_true"
+	)
+
+  argparser.add_argument(
+	  "-B", "--bold",
+	  help = "Display semigraphic characters in bold",
+	  action = "store_true"
+	)
+
+  argparser.add_argument(
+	  "--numpy",
+	  help = "Use NumPy to render the semigraphic characters",
+	  action = "store_true"
+	)
+
+  argparser.add_argument(
+	  "-s", "--screen-stream",
+	  help = "Get the display from the Flipper Zero's screen stream "
+			"instead of polling screen snapshots (falls back to "
+			"polling if the stream can't be started)",
+	  action = "store_true"
+	)
+
+  argparser.add_argument(
+	  "-f", "--fps",
+	  help = "Target display capture rate while the display changes. The "
+			"capture rate backs off while the display stays idle. "
+			"Default: {}".format(default_target_fps),
+	  type = float,
+	  default = default_target_fps
+	)
+
+  argparser.add_argument(
+	  "--max-fps",
+	  help = "Maximum display capture rate after input events or frames "
+			"pushed by the screen stream. Default: {}".
+			format(default_max_fps),
+	  type = float,
+	  default = default_max_fps
+	)
+
+  argparser.add_argument(
+	  "-i", "--incremental-redraw",
+	  help = "Only redraw the lines of the display that changed",
+	  action = "store_true"
+	)
+
+  argparser.add_argument(
+	  "-t", "--txt",
+	  help = "Text file to record the session into (play it back with "
+			"tfreplay or replay button presses encoded into it "
+			"with -r)",
+	  type = str
+	)
+
+  argparser.add_argument(
+	  "-g", "--gif",
+	  help = "Animated GIF to record the session into",
+	  action = argparse_gif_filename_parser
+	)
+
+  argparser.add_argument(
+	  "-b", "--bin",
+	  help = "Binary tfr file to record the session into (play it back "
+			"with tfreplay or replay button presses encoded into "
+			"it with -rb)",
+	  type = str
+	)
+
+  argparser.add_argument(
+	  "-D", "--gif-delta",
+	  help = "Only record the part of each frame that changed in the "
+			"animated GIF (smaller file, faster recording)",
+	  action = "store_true"
+	)
+
+  mutexargs = argparser.add_mutually_exclusive_group(required = False)
+
+  mutexargs.add_argument(
+	  "-rt", "--replay-buttons-from-txt",
+	  help = "Text file session recording to replay button presses from "
+			"(generated by -t)",
+	  type = str
+	)
+
+  mutexargs.add_argument(
+	  "-rg", "--replay-buttons-from-gif",
+	  help = "GIF file session recording to replay button presses from "
+			"(generated by -g)",
+	  type = str
+	)
+
+  mutexargs.add_argument(
+	  "-rb", "--replay-buttons-from-bin",
+	  help = "Binary tfr file session recording to replay button presses "
+			"from (generated by -b)",
+	  type = str
+	)
+
+  argparser.add_argument(
+	  "--replay-skew-log",
+	  help = "File to log the recorded and actual timecodes of the "
+			"replayed button presses into",
+	  type = str
+	)
+
+  argparser.add_argument(
+	  "--replay-speed",
+	  help = "Replay button presses this many times faster than they were "
+			"recorded. Default: 1",
+	  type = float,
+	  default = 1
+	)
+
+  argparser.add_argument(
+	  "--replay-max-idle",
+	  help = "Shorten the idle gaps between replayed button presses "
+			"longer than this many seconds (in record time) to "
+			"that duration",
+	  type = float
+	)
+
+  argparser.add_argument(
+	  "--sync",
+	  help = "Replay each button press as soon as the display matches the "
+			"recorded frame that preceded it instead of at its "
+			"recorded timecode",
+	  action = "store_true"
+	)
+
+  argparser.add_argument(
+	  "--sync-timeout",
+	  help = "How long to wait for the display to match the recorded frame "
+			"before replaying button presses anyway with --sync. "
+			"Default: {}s".format(default_sync_timeout),
+	  type = float,
+	  default = default_sync_timeout
+	)
+
+  argparser.add_argument(
+	  "-j", "--jobs",
+	  help = "Number of processes to decode the GIF file to replay button "
+			"presses from with. Default: 1",
+	  type = int,
+	  default = 1
+	)
+
+  argparser.add_argument(
+	  "-n", "--no-display",
+	  help = "Suppress the display output, only print button presses",
+	  action = "store_true"
+	)
+
+  argparser.add_argument(
+	  "--latency-probe",
+	  help = "Measure the input-to-photon latency instead of running a "
+			"normal session: send the button presses of this "
+			"script one by one (l, d, u, r, o or b for short "
+			"presses, uppercase for long presses), time how long "
+			"the display takes to change and the change takes to "
+			"be displayed, then print the latency distribution",
+	  type = str
+	)
+
+  argparser.add_argument(
+	  "--probe-timeout",
+	  help = "How long to wait for the display to change after each button "
+			"press with --latency-probe. Default: {}s".\
+			format(default_probe_timeout),
+	  type = float,
+	  default = default_probe_timeout
+	)
+
+  argparser.add_argument(
+	  "--stats",
+	  help = "Time the stages of the session and print the frame counters "
+			"and the latency percentiles and histograms of each "
+			"stage at the end",
+	  action = "store_true"
+	)
+
+  argparser.add_argument(
+	  "--trace",
+	  help = "Chrome trace JSON file to dump the timings of the stages of "
+			"the session into (open it in chrome://tracing or "
+			"Perfetto)",
+	  type = str
+	)
+
+  args = argparser.parse_args(argv)
+
+  if args.fps <= 0 or args.max_fps <= 0:
+    argparser.error("the capture rates must be strictly positive")
+
+  if args.jobs < 1:
+    argparser.error("the number of processes must be at least 1")
+
+  if args.latency_probe is not None:
+    if not re.fullmatch("[lLdDuUrRoObB]+", args.latency_probe):
+      argparser.error("the latency probe script may only contain l, d, u, r, "
+			"o and b in lowercase or uppercase")
+    if args.replay_buttons_from_txt or args.replay_buttons_from_gif or \
+		args.replay_buttons_from_bin:
+      argparser.error("--latency-probe can't replay button presses")
+    if args.probe_timeout <= 0:
+      argparser.error("the probe timeout must be strictly positive")
+
+  # If we run as a daemon, connect to the Flipper Zero and serve it to other
+  # tflipper instances until interrupted
+  if args.daemon:
+
+    if args.daemon_socket is None:
+      argparser.error("the tflipper daemon needs Unix sockets")
+
+    p = proto if proto is not None else FlipperProto(serial_port = args.device)
+
+    daemon = flipper_daemon(p, args.daemon_socket)
+    print("tflipper daemon serving {} on {} - Ctrl-C to stop".\
+		format(p.device_info["hardware_name"], args.daemon_socket),
+		file = sys.stderr)
+
+    try:
+      daemon.serve_forever()
+
+    except KeyboardInterrupt:
+      pass
+
+    finally:
+      daemon.close()
+
+    return 0
+
+  # Time the stages of the session if requested
+  if args.stats or args.trace or args.latency_probe:
+    stats.enable(trace = args.trace is not None)
+
+  replay_filename = args.replay_buttons_from_txt or \
+			args.replay_buttons_from_gif or \
+			args.replay_buttons_from_bin
+
+  if args.sync and not replay_filename:
+    argparser.error("--sync needs a session record to replay button presses "
+			"from")
+
+  if args.sync_timeout <= 0:
+    argparser.error("the sync timeout must be strictly positive")
+
+  if args.replay_speed <= 0:
+    argparser.error("the replay speed must be strictly positive")
+
+  if args.replay_max_idle is not None and args.replay_max_idle < 0:
+    argparser.error("the maximum replay idle gap must be positive")
+
+  keymap_help = semigraphic_keymap_help()
+
+  # Timecode of the last invisible marker of a text file to replay button
+  # presses from, whose button press events are parsed as they're replayed
+  txt_replay_last_timecode = None
+
+  # If we replay button presses in sync with the display, extract the button
+  # press events from the session record along with the frames that preceded
+  # them
+  if args.sync:
+    record = open_record(replay_filename)
+    try:
+      replay_buttons_at = replay_sync_points(record)
+    finally:
+      record.close()
+
+  # If a text file to replay button presses from was specified, parse the
+  # button press events from it as they're replayed, so the replay starts right
+  # away, and only get the last timecode from the end of the file for now
+  elif args.replay_buttons_from_txt:
+    replay_buttons_at = txt_replay_events(args.replay_buttons_from_txt)
+    txt_replay_last_timecode = txt_last_timecode(args.replay_buttons_from_txt)
+
+  # If a GIF file to replay button presses from was specified, load it and
+  # extract the button press events from it
+  elif args.replay_buttons_from_gif:
+
+    with Image.open(args.replay_buttons_from_gif) as gif:
+      assert gif.is_animated
+      assert gif.size == (512, 256)
+      assert len(gif.palette.colors) >= 4
+
+    # Only decode the first line of the frames, where the invisible markers
+    # are encoded
+    replay_buttons_at = []
+    for line in gif_first_lines(args.replay_buttons_from_gif, args.jobs):
+      s = steg_decode_bits(line.translate(steg_index_to_bit))
+      replay_buttons_at.extend([(float(t), b) \
+				for t, b in re_tc_btn_marker.findall(s)])
+
+  # If a tfr file to replay button presses from was specified, extract the
+  # button press events from it
+  elif args.replay_buttons_from_bin:
+    with tfr_reader(args.replay_buttons_from_bin) as tfr:
+      replay_buttons_at = tfr.markers()
+
+  # No file to replay button presses from
+  else:
+    replay_buttons_at = None
+
+  # If we replay button presses, prune empty button presses apart from the last
+  # one that marks the end of the replay, then speed up the replay and shorten
+  # the idle gaps if requested
+  replay_projected_duration = None
+  if replay_buttons_at is not None:
+    replay_buttons_at = rescale_replay_events(
+				prune_replay_events(replay_buttons_at),
+				args.replay_speed, args.replay_max_idle)
+
+    # Tell how long the replay should take. If the button press events are
+    # parsed as they're replayed, the projected run time only comes from the
+    # last timecode, and it's an upper bound if the idle gaps are shortened
+    if args.replay_buttons_from_txt and not args.sync:
+      if txt_replay_last_timecode is not None:
+        print("Replaying button press events - projected run time: {}"
+		"{:0.1f}s".format("at most " if args.replay_max_idle \
+						is not None else "",
+				txt_replay_last_timecode / args.replay_speed),
+		file = sys.stderr)
+        if args.replay_max_idle is None:
+          replay_projected_duration = txt_replay_last_timecode / \
+					args.replay_speed
+
+    else:
+      replay_buttons_at = list(replay_buttons_at)
+      replay_projected_duration = replay_buttons_at[-1][0] \
+					if replay_buttons_at else 0
+      print("Replaying {} button press events - projected run time: "
+		"{:0.1f}s".format(len([e for e in replay_buttons_at if e[1]]),
+				replay_projected_duration),
+		file = sys.stderr)
+
+  # Connect to the Flipper Zero through the tflipper daemon if one is running
+  # and no serial device was given, otherwise directly
+  p = proto
+  daemon_client = None
+
+  if p is None and not args.no_daemon and args.device is None:
+    p = daemon_client = connect_to_daemon(args.daemon_socket)
+
+    if daemon_client is not None and args.screen_stream:
+      daemon_client.close()
+      argparser.error("the screen stream isn't available through the "
+			"tflipper daemon: use --no-daemon")
+
+  if p is None:
+    p = FlipperProto(serial_port = args.device)
+
+  # Get the Flipper Zero's name
+  flipper_name = "[ " + p.device_info["hardware_name"] + " ]"
+
+  # Create a queue for the input thread to send messages to the main thread
+  q = multiprocessing.Queue()
+
+  # Get the display from the screen stream if requested and if the stream can
+  # be started, otherwise poll screen snapshots. The screen stream wakes up the
+  # main thread with an empty input event string every time a frame is pushed
+  screen = None
+  if args.screen_stream:
+    screen = screen_stream_reader(p, on_frame = lambda: q.put(("", None)))
+    try:
+      screen.start()
+    except Exception as e:
+      print("Cannot start the screen stream ({}): polling screen snapshots "
+		"instead".format(e), file = sys.stderr)
+      screen = None
+
+  if screen is None:
+    screen = screen_snapshot_poller(p)
+
+  # If we probe the input-to-photon latency, do only that, rendering the frames
+  # straight from this thread so they can be timed
+  if args.latency_probe:
+
+    display = display_output(args, flipper_name, "[ Ctrl-C to stop ]",
+				keymap_help)
+    probe = latency_probe(screen, display, args.latency_probe,
+				args.probe_timeout)
+
+    try:
+      probe.run()
+
+    except KeyboardInterrupt:
+      pass
+
+    finally:
+      display.finish(probe.timecode(), "")
+      screen.stop()
+      if daemon_client is not None:
+        daemon_client.close()
+
+    print(probe.report(), file = sys.stderr)
+    print(stats.report(), file = sys.stderr)
+
+    if args.trace:
+      stats.dump_trace(args.trace)
+
+    return 0
+
+  # Bottom help line
+  bottom_line = ("[ Ctrl-K to show/hide keymap ]     " \
+				if replay_buttons_at is None else "") + \
+			"[ Ctrl-C to stop ]"
+
+  # Spawn the input thread to get keypresses if we don't replay button
+  # presses, otherwise prepare to replay them from the replay scheduler's
+  # thread, waking up the main thread every time button presses are replayed
+  replayer = None
+  if replay_buttons_at is None:
+    t = threading.Thread(target = input_thread, args = (q,))
+    t.start()
+  elif args.sync:
+    replayer = sync_replay_scheduler(replay_buttons_at, screen.send_input,
+				args.sync_timeout,
+				on_replay = lambda: q.put(("", None)),
+				skew_log = open(args.replay_skew_log, "w") \
+					if args.replay_skew_log else None,
+				projected_duration = replay_projected_duration)
+  else:
+    replayer = replay_scheduler(replay_buttons_at, screen.send_input,
+				on_replay = lambda: q.put(("", None)),
+				skew_log = open(args.replay_skew_log, "w") \
+					if args.replay_skew_log else None,
+				projected_duration = replay_projected_duration)
+
+  # Start the consumer stages: the display, and the text file, GIF and tfr
+  # recorders if the session is recorded. The display drops frames it can't
+  # keep up with unless it only prints button presses
+  display_stage = pipeline_stage(display_output(args, flipper_name,
+						bottom_line, keymap_help),
+				display_queue_size,
+				"block" if args.no_display else "drop",
+				"display")
+
+  recorder_stages = []
+
+  if args.txt:
+    recorder_stages.append(pipeline_stage(txt_recorder(args, flipper_name),
+					recorder_queue_size, "block",
+					"txt recorder"))
+
+  if args.gif:
+    recorder_stages.append(pipeline_stage(gif_recorder(args),
+					recorder_queue_size, "block",
+					"gif recorder"))
+
+  if args.bin:
+    recorder_stages.append(pipeline_stage(tfr_recorder(args, flipper_name),
+					recorder_queue_size, "block",
+					"tfr recorder"))
+
+  show_keymap = False
+
+  start_time = None
+
+  flipper_inputs = ""
+
+  screen_data = b""
+  update_display = True
+
+  scheduler = frame_rate_scheduler(args.fps, args.max_fps)
+
+  replay_finished = False
+
+  try:
+
+    # Run until stopped by Ctrl-C
+    while True:
+
+      flipper_inputs = ""
+
+      # Wait until the next capture is due, unless a message arrives in the
+      # meantime
+      wait = scheduler.time_to_next_capture()
+
+      # Process messages from the input thread
+      while True:
+
+        # Try to get one message out of the queue, waiting for the first one
+        try:
+          flipper_input, e = q.get(timeout = wait) if wait > 0 else \
+				q.get_nowait()
+
+        except queue.Empty:
+          break
+
+        wait = 0
+
+        # If we got an exception from the input thread, re-raise it
+        if e is not None:
+          raise e
+
+        # Do we have a Flipper Zero input event string?
+        elif flipper_input is not None:
+
+          # Should we show or hide the keymap?
+          if flipper_input == "k":
+
+            show_keymap = not show_keymap
+            update_display = True
+            scheduler.wake()
+
+          # If the string isn't empty, send the event to the Flipper Zero and
+          # store them for recording in the session text file in short form
+          elif flipper_input:
+            screen.send_input(flipper_input)
+            scheduler.input_sent()
+            i1, i2 = flipper_input.split()
+            flipper_inputs += i2[0].lower() if i1 == "SHORT" else i2[0].upper()
+
+          # If the string is empty, either the key isn't mapped or the screen
+          # stream pushed a new frame: capture it as soon as possible
+          else:
+            scheduler.wake()
+
+        # The input thread exited normally so do the same thing
+        else:
+          raise KeyboardInterrupt
+
+      # Get the current time and calculate the current timecode. Start
+      # replaying button presses at the start of the session
+      now = time()
+      if start_time is None:
+        start_time = now
+        if replayer is not None:
+          replayer.start()
+      timecode = now - start_time
+      if timecode < 0:
+        timecode = 0
+
+      # Do we replay button presses?
+      if replayer is not None:
+
+        # If there are no buttons left to replay and the last ones have been
+        # recorded, stop as if the user hit Ctrl-C
+        if replay_finished:
+          raise KeyboardInterrupt
+
+        # Add the button presses the replay scheduler sent to the Flipper Zero
+        # since the last time to the inputs
+        btns, replay_finished = replayer.get_replayed()
+        flipper_inputs += btns
+        if btns:
+          scheduler.input_sent()
+
+        # Capture the display as fast as possible while the replay scheduler
+        # waits for it to match the recorded frame
+        if args.sync and replayer.waiting_for_sync:
+          scheduler.input_sent()
+
+        if replay_finished and not flipper_inputs:
+          raise KeyboardInterrupt
+
+      # If no input was sent and the display doesn't need updating, wait some
+      # more if the next capture isn't due yet
+      if not flipper_inputs and not update_display and \
+		scheduler.time_to_next_capture() > 0:
+        continue
+
+      # Get the Flipper Zero's display
+      prev_screen_data = screen_data
+      capture_start = stats.clock()
+      screen_data = screen.get_frame(timeout = 0)
+      stats.timed("capture", capture_start)
+      assert len(screen_data) == 1024
+      screen_data_changed = screen_data != prev_screen_data
+      scheduler.frame_captured(screen_data_changed)
+
+      stats.count("frames captured")
+      if screen_data_changed:
+        stats.count("frames changed")
+
+      if args.sync and replayer is not None:
+        replayer.frame_captured(screen_data)
+
+      frame = captured_frame(timecode, screen_data, flipper_inputs,
+				show_keymap)
+
+      # Pass the frame on to the recorders if we have a reason to record it
+      if screen_data_changed or flipper_inputs:
+        for stage in recorder_stages:
+          stage.put(frame)
+
+      # Pass the frame on to the display if it should be updated
+      if screen_data_changed or update_display or flipper_inputs:
+        display_stage.put(frame)
+        update_display = False
+
+  except KeyboardInterrupt:
+    pass
+
+  except:
+    raise
+
+  finally:
+
+    # Get the current time and calculate this last output's timecode
+    now = time()
+    if start_time is None:
+      start_time = now
+    timecode = now - start_time
+
+    # Let the recorders and the display finish processing their frames, then
+    # record and output the last timecode and button presses. Finish all the
+    # stages even if one of them failed so the display gets cleaned up
+    stage_exception = None
+    for stage in recorder_stages + [display_stage]:
+      try:
+        stage.finish(timecode, flipper_inputs)
+      except Exception as e:
+        stage_exception = stage_exception or e
+
+    # Stop replaying button presses and report how precisely they were timed
+    if replayer is not None:
+      replayer.stop()
+      print(replayer.report(), file = sys.stderr)
+
+    # Stop getting the Flipper Zero's display and disconnect from the daemon if
+    # we went through it
+    screen.stop()
+    if daemon_client is not None:
+      daemon_client.close()
+
+    # Report where the time went if requested
+    if args.stats:
+      stats.count("frames dropped by the display",
+			display_stage.nb_dropped_frames)
+      print(stats.report(), file = sys.stderr)
+
+    if args.trace:
+      stats.dump_trace(args.trace)
 
     # If we're not replaying button presses, tell the input thread to stop if
     # it hasn't stopped by itself already and join the thread
@@ -1017,42 +4460,9 @@ def main():
       setattr(t, "do_run", False)
       t.join()
 
-  # If GIF frames were recorded and we have at least one frame, save them as an
-  # animated GIF
-  if gif_frames:
-
-    # Add a copy of the first and last frames with a very small duration
-    # to the start and the end of the animation respectively, because
-    # some video players don't play edge frames with the correct
-    # duration -e.g. mplayer
-
-    # Duplicate of the first frame with frame number -1 invisible encoded in it
-    gif_frame_durations_ms[0] = max(gif_frame_durations_ms[0] - \
-					min_gif_frame_duration_ms,
-					min_gif_frame_duration_ms)
-    image = copy(gif_frames[0])
-    steg_encode(image, "[-1]")
-    gif_frames.insert(0, image)
-    gif_frame_durations_ms.insert(0, min_gif_frame_duration_ms)
-
-    # Duplicate of the last frame with the last frame number, last timecode and
-    # last flipper inputs invisibly encoded in it
-    gif_frame_durations_ms[-1] = max(gif_frame_durations_ms[-1] - \
-					min_gif_frame_duration_ms,
-					min_gif_frame_duration_ms)
-    image = copy(gif_frames[-1])
-    steg_encode(image, "[{}] ".format(gif_frame_no) + \
-				set_text_invisible + \
-				invisible_tc_btn_marker_fmt.
-					format(timecode, flipper_inputs)  + \
-				attributes_reset)
-    gif_frames.append(image)
-    gif_frame_durations_ms.append(min_gif_frame_duration_ms)
-
-    # Encode and save the animated GIF file
-    gif_frames[0].save(args.gif, save_all = True,
-			append_images = gif_frames[1:], optimize = False,
-			duration = gif_frame_durations_ms, loop = 0)
+    # Re-raise the exception of the first stage that failed
+    if stage_exception is not None:
+      raise stage_exception
 
   return 0
 
@@ -1,18 +1,22 @@
 #!/usr/bin/env python3
 """Flipper Zero remote control for the terminal
-Version: 1.7.1
+Version: 1.8.0
 
 Record player
 
-Replay sessions recorded with tflipper -r
+Replay sessions recorded with tflipper -t or tflipper -b
 """
 
 ## Modules
 #
 
+import os
 import re
 import sys
+import mmap
+import struct
 import argparse
+from bisect import bisect_right
 from time import time, sleep
 
 try:
@@ -45,84 +49,284 @@ attributes_reset = ESC + "[0m"
 # VT100 x lines up
 x_lines_up = ESC + "[{}A"
 
+# Magic at the start of binary tfr session record files
+tfr_magic = b"TFR1"
 
+# Precompiled regex for an invisible timecode and button presses marker
+re_tc_btn_marker = re.compile((set_text_invisible.replace("[", "\\[") + \
+				r"\[([0-9]+\.[0-9]{3})s\] " \
+				r"\[[lLdDuUrRoObB]*\]" + \
+				attributes_reset.replace("[", "\\[")).\
+				encode("ascii"))
 
-## Main routine
+# Precompiled regex for a x-lines-up sequence
+re_x_lines_up = re.compile(x_lines_up.replace("[", "\\[").\
+				format("([0-9]+)").encode("ascii"))
+
+# Pre-encoded special characters and VT100 sequences
+LF_b = LF.encode("ascii")
+set_cursor_invisible_b = set_cursor_invisible.encode("ascii")
+
+# How late playback may run in real time mode before frames are dropped
+default_max_lag = 0.1 #s
+
+# Extension of the timecode index cached next to text session records, and
+# structure of the index file
+index_file_ext = ".idx"
+index_magic = b"TFI1"
+index_header_fmt = "<4sQQ"	# Magic, record size, record modification time
+index_entry_fmt = "<dQ"		# Timecode, offset of the marker in the record
+
+
+
+## Routines
 #
 
-def main():
+class utf8_stdout:
+  """Text stream writing UTF-8 encoded text to the standard output
+  """
 
-  # If we run on Windows, initialize colorama, so the Windows console
-  # understands ANSI escape codes
-  if sys.platform[0:3] == "win":
-    colorama.init()
+  def write(self, s):
+    """Write a string
+    """
 
-  # Parse the command line arguments
-  argparser = argparse.ArgumentParser()
+    sys.stdout.buffer.write(s.encode("utf-8"))
 
-  argparser.add_argument(
-	  "record",
-	  help = "tflipper session record file to play",
-	  type = str
-	)
 
-  args = argparser.parse_args()
 
-  # Precompiled regex for an invisible timecode and button presses marker
-  re_tc_btn_marker = re.compile((set_text_invisible.replace("[", "\\[") + \
-					r"\[([0-9]+\.[0-9]{3})s\] " \
-					r"\[[lLdDuUrRoObB]*\]" + \
-					attributes_reset.replace("[", "\\[")).\
-					encode("ascii"))
+  def flush(self):
+    """Flush the standard output
+    """
 
-  # Precompiled regex for a x-lines-up sequence
-  re_x_lines_up = re.compile(x_lines_up.replace("[", "\\[").\
-				format("([0-9]+)").encode("ascii"))
+    sys.stdout.buffer.flush()
+
+
+
+class playback_clock:
+  """Wait until frames are due, starting from the timecode given with --from,
+  at the speed given with --speed, with idle gaps between frames shortened to
+  the duration given with --max-idle. In real time mode, tell when playback is
+  so late that a frame should be dropped
+  """
+
+  def __init__(self, args):
+    """__init__ method
+    """
+
+    self.speed = args.speed
+    self.max_idle = args.max_idle
+    self.realtime = args.realtime
+    self.max_lag = args.max_lag
+
+    self.prev_timecode = args.from_timecode
+    self.start_time = None
+    self.playback_time = 0
+
+
+
+  def due_time(self, timecode):
+    """Return the time the frame with this timecode is due. Called for each
+    frame in sequence
+    """
+
+    if self.start_time is None:
+      self.start_time = time()
+
+    # Frames before the start timecode are due immediately
+    gap = max(timecode - self.prev_timecode, 0)
+    if self.max_idle is not None:
+      gap = min(gap, self.max_idle)
+
+    self.playback_time += gap / self.speed
+    self.prev_timecode = max(timecode, self.prev_timecode)
+
+    return self.start_time + self.playback_time
+
+
+
+  def wait(self, due_time):
+    """Wait until a frame is due
+    """
+
+    wait = due_time - time()
+    if wait > 0:
+      sleep(wait)
+
+
+
+  def schedule(self, frames):
+    """Generator returning each frame -whose first element is its timecode-
+    with the time it's due and the time the next frame is due, or None after
+    the last frame
+    """
+
+    prev_frame = None
+
+    for frame in frames:
+      due_time = self.due_time(frame[0])
+      if prev_frame is not None:
+        yield prev_frame + (due_time,)
+      prev_frame = (frame, due_time)
+
+    if prev_frame is not None:
+      yield prev_frame + (None,)
+
+
+
+  def late(self, due_time, next_due_time):
+    """Return True if frames are dropped to play in real time, playback is late
+    by more than the longest lag on a frame, and the next frame is already due
+    """
+
+    if not self.realtime or next_due_time is None:
+      return False
+
+    now = time()
+
+    return now - due_time > self.max_lag and next_due_time <= now
+
+
+
+def report_dropped_frames(args, nb_dropped_frames):
+  """Report how many frames were dropped in real time mode
+  """
+
+  if args.realtime:
+    print("{} frame{} dropped".format(nb_dropped_frames,
+				"" if nb_dropped_frames == 1 else "s"),
+		file = sys.stderr)
+
+
+
+def load_txt_index(filename):
+  """Return the timecodes of the markers in a text session record and their
+  offsets in the file from the index cached next to the record, or None if
+  there is no cached index or the record changed since it was cached
+  """
+
+  st = os.stat(filename)
+
+  try:
+    with open(filename + index_file_ext, "rb") as f:
+      data = f.read()
+    magic, size, mtime = struct.unpack_from(index_header_fmt, data, 0)
+    if magic == index_magic and size == st.st_size and \
+		mtime == st.st_mtime_ns:
+      return list(struct.iter_unpack(index_entry_fmt,
+				data[struct.calcsize(index_header_fmt):]))
+  except:
+    pass
+
+  return None
+
+
+
+def save_txt_index(filename, index):
+  """Cache the index of a text session record next to it if possible
+  """
+
+  st = os.stat(filename)
+
+  try:
+    with open(filename + index_file_ext, "wb") as f:
+      f.write(struct.pack(index_header_fmt, index_magic, st.st_size,
+				st.st_mtime_ns) + \
+		b"".join([struct.pack(index_entry_fmt, *entry) \
+				for entry in index]))
+  except:
+    pass
+
+
+
+def scan_txt_index(filename, data):
+  """Generator returning the timecodes of the markers in a text session record
+  and their offsets in the file as they're found in the memory-mapped record.
+  The index is cached once the whole record has been scanned
+  """
+
+  index = []
+
+  for m in re_tc_btn_marker.finditer(data):
+    index.append((float(m[1]), m.start()))
+    yield index[-1]
+
+  save_txt_index(filename, index)
+
+
+
+def txt_frames(args, data):
+  """Generator returning the timecode and the start and end offsets of the
+  ANSI text of each frame of a memory-mapped text session record, from the
+  frame showing at the start timecode. Each frame starts at its marker, and
+  the last marker is followed by the text that skips past the rendering
+  """
+
+  index = load_txt_index(args.record)
+  markers = iter(index) if index is not None \
+		else scan_txt_index(args.record, data)
+
+  # The first frame also includes what comes before its marker
+  timecode, start = next(markers, (None, None))
+  if timecode is None:
+    return
+  start = 0
 
-  # Precompiled regex for line feeds
-  re_lf = re.compile(LF.encode("ascii"))
+  # Return the frames from the last frame with a timecode before the start
+  # timecode up to the last marker, then the last marker to the end of the
+  # record
+  for next_timecode, next_start in markers:
+    if next_timecode > args.from_timecode:
+      yield timecode, start, next_start
+    timecode, start = next_timecode, next_start
+
+  yield timecode, start, len(data)
+
+
+
+def play_txt(args):
+  """Play a text session record, from the frame showing at the start
+  timecode, writing each frame's ANSI text in one go
+  """
+
+  clock = playback_clock(args)
 
   nb_lines_back_up = 0
+  nb_dropped_frames = 0
 
   cursor_visible = True
-  start_time = time()
 
   f = None
 
   try:
 
-    # Open the record
-    with open(args.record, "rb") as f:
+    # Open and memory-map the record
+    with open(args.record, "rb") as f, \
+		mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as data:
 
-      # Read the file line by line
-      for l in f.readlines():
+      for (_, start, end), due_time, next_due_time in \
+		clock.schedule(txt_frames(args, data)):
 
-        # Does the line contain an invisible timecode and button presses marker?
-        m = re_tc_btn_marker.search(l)
-        if m:
+        frame = data[start : end]
 
-          # Wait long enough to reproduce the same delay as originally recorded
-          wait = float(m[1]) - time() + start_time
-          if wait > 0:
-            sleep(wait)
+        # Keep track of the lines the cursor moves up and down
+        nb_lines_back_up += sum(map(int, re_x_lines_up.findall(frame))) - \
+				frame.count(LF_b)
 
-        # Does the line contain x-lines-up sequences?
-        m = re_x_lines_up.findall(l)
-        if m:
-          nb_lines_back_up += sum(map(int, m))
+        # Drop the frame if playback is too late and the next one is due
+        if clock.late(due_time, next_due_time):
+          nb_dropped_frames += 1
+          continue
 
-        # Does the line contain line feeds?
-        m = re_lf.findall(l)
-        if m:
-          nb_lines_back_up -= len(m)
+        # Wait long enough to reproduce the same delay as originally recorded
+        clock.wait(due_time)
 
         # Hide the cursor if needed
         if cursor_visible:
-          sys.stdout.buffer.write(set_cursor_invisible.encode("ascii"))
+          frame = set_cursor_invisible_b + frame
           cursor_visible = False
 
-        # Print the line
-        sys.stdout.buffer.write(l)
+        # Print the frame
+        sys.stdout.buffer.write(frame)
         sys.stdout.buffer.flush()
 
     f = None
@@ -135,7 +339,7 @@ def main():
 
     # Add an extra LF in case the playback was interrupted
     if f is not None:
-      sys.stdout.buffer.write(LF.encode("ascii"))
+      sys.stdout.buffer.write(LF_b)
 
   except:
     raise
@@ -152,10 +356,175 @@ def main():
 
     sys.stdout.buffer.flush()
 
+    report_dropped_frames(args, nb_dropped_frames)
+
   return 0
 
 
 
+def play_tfr(args):
+  """Play a binary tfr session record by rendering its frames the same way
+  tflipper renders them into a text session record, from the frame showing at
+  the start timecode
+  """
+
+  # Only import tflipper, and the modules it needs to talk to the Flipper Zero,
+  # when playing a tfr record
+  import tflipper
+
+  timecode = 0
+  flipper_inputs = ""
+
+  with tflipper.tfr_reader(args.record) as tfr:
+
+    player = tflipper.txt_recorder(args, tfr.flipper_name, utf8_stdout())
+
+    # Start from the last frame with a timecode before the start timecode
+    start = max(bisect_right([timecode for _, timecode, _ in tfr.index],
+				args.from_timecode) - 1, 0)
+
+    clock = playback_clock(args)
+    nb_dropped_frames = 0
+
+    sys.stdout.buffer.write(set_cursor_invisible.encode("ascii"))
+
+    try:
+
+      for frame, due_time, next_due_time in clock.schedule(tfr.frames(start)):
+
+        # Drop the frame if playback is too late and the next one is due
+        if clock.late(due_time, next_due_time):
+          nb_dropped_frames += 1
+          continue
+
+        # Wait long enough to reproduce the same delay as originally recorded
+        clock.wait(due_time)
+
+        player.process(frame)
+        player.rt.flush()
+        timecode = frame.timecode
+
+      # Wait until the end of the recording
+      if tfr.end is not None:
+        clock.wait(clock.due_time(tfr.end[0]))
+        timecode, flipper_inputs = tfr.end
+
+    except KeyboardInterrupt:
+      pass
+
+    finally:
+
+      # Skip past the rendering and show the cursor again
+      player.finish(timecode, flipper_inputs)
+      sys.stdout.buffer.write(set_cursor_visible.encode("ascii"))
+      sys.stdout.buffer.flush()
+
+      report_dropped_frames(args, nb_dropped_frames)
+
+  return 0
+
+
+
+## Main routine
+#
+
+def main():
+
+  # If we run on Windows, initialize colorama, so the Windows console
+  # understands ANSI escape codes
+  if sys.platform[0:3] == "win":
+    colorama.init()
+
+  # Parse the command line arguments
+  argparser = argparse.ArgumentParser()
+
+  argparser.add_argument(
+	  "record",
+	  help = "tflipper session record file to play",
+	  type = str
+	)
+
+  argparser.add_argument(
+	  "-f", "--from",
+	  help = "Timecode in seconds to start playing the record from. "
+			"Default: 0",
+	  type = float,
+	  default = 0,
+	  dest = "from_timecode"
+	)
+
+  argparser.add_argument(
+	  "-s", "--speed",
+	  help = "Playback speed factor. Default: 1",
+	  type = float,
+	  default = 1
+	)
+
+  argparser.add_argument(
+	  "-i", "--max-idle",
+	  help = "Shorten the idle gaps between frames longer than this many "
+			"seconds (in record time) to that duration",
+	  type = float
+	)
+
+  argparser.add_argument(
+	  "-r", "--realtime",
+	  help = "Drop frames to keep up with the record's timing when the "
+			"console can't draw them fast enough",
+	  action = "store_true"
+	)
+
+  argparser.add_argument(
+	  "--max-lag",
+	  help = "How late playback may run in real time mode before frames "
+			"are dropped, in seconds. Default: {}".\
+			format(default_max_lag),
+	  type = float,
+	  default = default_max_lag
+	)
+
+  argparser.add_argument(
+	  "-M", "--mid-density-semigraphics",
+	  help = "Play binary tfr records with 2x3 unicode block characters. "
+			"Default: 1x2 unicode block characters",
+	  action = "store_true"
+	)
+
+  argparser.add_argument(
+	  "-H", "--high-density-semigraphics",
+	  help = "Play binary tfr records with 2x4 unicode Braille characters. "
+			"Default: 1x2 unicode block characters",
+	  action = "store_true"
+	)
+
+  argparser.add_argument(
+	  "-B", "--bold",
+	  help = "Play binary tfr records with semigraphic characters in bold",
+	  action = "store_true"
+	)
+
+  argparser.set_defaults(numpy = False)
+
+  args = argparser.parse_args()
+
+  if args.speed <= 0:
+    argparser.error("the playback speed must be strictly positive")
+
+  if args.max_idle is not None and args.max_idle < 0:
+    argparser.error("the longest idle gap can't be negative")
+
+  # Binary tfr records are rendered on the fly. A tfr record cut short before
+  # the end of its magic is reported as an invalid tfr file too
+  with open(args.record, "rb") as f:
+    magic = f.read(len(tfr_magic))
+    if magic == tfr_magic[:len(magic)] and \
+		(magic or args.record.lower().endswith(".tfr")):
+      return play_tfr(args)
+
+  return play_txt(args)
+
+
+
 ## Main program
 #
 
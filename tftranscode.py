@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""Flipper Zero remote control for the terminal
+Version: 1.8.0
+
+Record transcoder
+
+Convert sessions recorded with tflipper -t, -g or -b between the text, GIF
+and binary tfr formats, and between semigraphic densities
+"""
+
+## Modules
+#
+
+import os
+import sys
+import argparse
+import multiprocessing
+from time import time
+
+import tflipper
+
+
+
+## Main routine
+#
+
+def main():
+
+  # Parse the command line arguments
+  argparser = argparse.ArgumentParser()
+
+  argparser.add_argument(
+	  "input",
+	  help = "tflipper session record to convert (text, GIF or tfr file)",
+	  type = str
+	)
+
+  argparser.add_argument(
+	  "output",
+	  help = "Session record to write. The format is determined by the "
+			"extension: .txt, .gif or .tfr",
+	  type = str
+	)
+
+  argparser.add_argument(
+	  "-M", "--mid-density-semigraphics",
+	  help = "Render text records with 2x3 unicode block characters. "
+			"Default: 1x2 unicode block characters",
+	  action = "store_true"
+	)
+
+  argparser.add_argument(
+	  "-H", "--high-density-semigraphics",
+	  help = "Render text records with 2x4 unicode Braille characters. "
+			"Default: 1x2 unicode block characters",
+	  action = "store_true"
+	)
+
+  argparser.add_argument(
+	  "-B", "--bold",
+	  help = "Render text records with semigraphic characters in bold",
+	  action = "store_true"
+	)
+
+  argparser.add_argument(
+	  "-D", "--gif-delta",
+	  help = "Only record the part of each frame that changed in GIF "
+			"records",
+	  action = "store_true"
+	)
+
+  argparser.add_argument(
+	  "-N", "--name",
+	  help = "Name of the Flipper Zero to write in text and tfr records. "
+			"Default: the name in the input record if any",
+	  type = str
+	)
+
+  argparser.add_argument(
+	  "-j", "--jobs",
+	  help = "Number of processes to parse and encode the frames with. "
+			"Default: number of CPUs",
+	  type = int,
+	  default = os.cpu_count() or 1
+	)
+
+  args = argparser.parse_args()
+
+  if args.jobs < 1:
+    argparser.error("the number of processes must be at least 1")
+
+  ext = os.path.splitext(args.output)[1].lower()
+  if ext not in (".txt", ".gif", ".tfr"):
+    argparser.error("unknown output format {}".format(ext))
+
+  # Arguments passed down to the tflipper recorders
+  args.numpy = False
+  args.txt = args.output if ext == ".txt" else None
+  args.gif = args.output if ext == ".gif" else None
+  args.bin = args.output if ext == ".tfr" else None
+
+  start_time = time()
+
+  pool = multiprocessing.Pool(args.jobs) if args.jobs > 1 else None
+  record = None
+
+  try:
+
+    record = tflipper.open_record(args.input, pool)
+
+    flipper_name = "[ " + args.name + " ]" if args.name \
+			else record.flipper_name
+
+    if args.txt:
+      recorder = tflipper.txt_recorder(args, flipper_name)
+    elif args.gif:
+      recorder = tflipper.gif_recorder(args, pool)
+    else:
+      recorder = tflipper.tfr_recorder(args, flipper_name)
+
+    nb_frames = 0
+    timecode = 0
+
+    for frame in record.frames():
+      recorder.process(frame)
+      nb_frames += 1
+      timecode = frame.timecode
+
+    recorder.finish(*(record.end if record.end is not None \
+				else (timecode, "")))
+
+  finally:
+
+    if record is not None:
+      record.close()
+
+    if pool is not None:
+      pool.close()
+      pool.join()
+
+  print("{} frames converted in {:0.1f}s".\
+		format(nb_frames, time() - start_time))
+
+  return 0
+
+
+
+## Main program
+#
+
+if __name__ == "__main__":
+  sys.exit(main())